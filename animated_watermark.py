@@ -0,0 +1,349 @@
+#!/usr/bin/env python3
+"""
+Watermarking for animated images (GIF, APNG, animated WebP) and video.
+Frames are streamed through in chunks processed on a thread pool: the visible
+mark is rendered once and blended into each frame's pixels in place, and the
+invisible mark is embedded on keyframes. Video is decoded and encoded through
+local ffmpeg pipes as raw RGB, so memory is bounded by the chunks in flight
+whatever the length of the clip.
+"""
+
+import io
+import json
+import os
+import shutil
+import subprocess
+import tempfile
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+from PIL import Image, ImageSequence
+
+import invisible_payload
+
+VIDEO_EXTENSIONS = ('.mp4', '.mov', '.mkv', '.avi', '.webm', '.m4v')
+
+# Animated formats Pillow can write back, with their output extension
+ANIMATED_FORMATS = {'GIF': '.gif', 'PNG': '.png', 'WEBP': '.webp'}
+
+# Extensions whose files may hold an animation
+ANIMATION_EXTENSIONS = ('.gif', '.png', '.apng', '.webp')
+
+# Codecs that keep RGB samples exactly (so the invisible mark survives), with the pixel format they take
+LOSSLESS_CODECS = {'libx264rgb': 'rgb24', 'ffv1': 'bgr0', 'png': 'rgb24'}
+
+# Lossless codecs that are only lossless at this constant rate factor
+LOSSLESS_CRF = {'libx264rgb': 0}
+
+
+def motion_kind(path, data=None):
+    """
+    Classify an input for routing
+
+    Videos are recognised by extension alone. Animations can only be told apart
+    from still images by their contents, so they are detected in data, the
+    file's bytes once the caller has read them; nothing is read from disk here.
+
+    Args:
+        path (str): Input file
+        data (bytes): Contents of path if already read
+
+    Returns:
+        str: 'video', 'animation' (multi-frame GIF/APNG/WebP) or None for still images
+    """
+    ext = os.path.splitext(path)[1].lower()
+    if ext in VIDEO_EXTENSIONS:
+        return 'video'
+    if data is None or ext not in ANIMATION_EXTENSIONS:
+        return None
+    try:
+        # Only parses the headers (GIF checks for a second frame), no pixels are decoded
+        with Image.open(io.BytesIO(data)) as img:
+            if img.format in ANIMATED_FORMATS and getattr(img, 'is_animated', False):
+                return 'animation'
+    except Exception:
+        pass  # Unreadable files are reported by the still-image path
+    return None
+
+
+class FrameMarker:
+    def __init__(self, bot, size, add_invisible=True, add_visible=True, visible_text="© 2024",
+                 visible_positions=None, font_size=24, opacity=70, invisible_text="Protected",
+                 keyframe_interval=1):
+        """
+        Watermark state shared by every frame of one clip
+
+        Args:
+            bot (WatermarkBot): Bot supplying the watermark key, error correction and font
+            size (tuple): (width, height) of the frames
+            keyframe_interval (int): Embed the invisible mark on every Nth frame
+            Other arguments: Same as WatermarkBot.watermark_frame
+        """
+        self.bot = bot
+        self.add_invisible = add_invisible
+        self.invisible_text = invisible_text
+        self.keyframe_interval = max(1, keyframe_interval)
+        self.patches = []
+        if add_visible:
+            for x, y, patch in bot.render_mark_patches(size, visible_text, visible_positions,
+                                                       opacity=opacity, font_size=font_size):
+                alpha = patch[..., 3:].astype(np.uint16)
+                self.patches.append((x, y, Image.fromarray(patch),
+                                     patch[..., :3].astype(np.uint16) * alpha, 255 - alpha))
+
+    def is_keyframe(self, index):
+        return index % self.keyframe_interval == 0
+
+    def apply(self, frame, index):
+        """
+        Watermark one frame in place
+
+        Args:
+            frame (numpy.ndarray): (height, width, 3) RGB or (height, width, 4) RGBA uint8 pixels
+            index (int): Position of the frame in the clip
+        """
+        if self.add_invisible and self.is_keyframe(index):
+            invisible_payload.embed(frame[..., :3], 'RGB', self.invisible_text,
+                                    key=self.bot.watermark_key, ecc_symbols=self.bot.ecc_symbols)
+        for x, y, patch, premultiplied, inverse_alpha in self.patches:
+            height, width = premultiplied.shape[:2]
+            roi = frame[y:y + height, x:x + width]
+            if frame.shape[2] == 4:
+                # Transparent frames need the full compositing equation, as for stills
+                roi[:] = np.asarray(Image.alpha_composite(Image.fromarray(roi), patch))
+            else:
+                roi[:] = (premultiplied + roi * inverse_alpha + 127) // 255
+
+
+def _mark_chunk(marker, start, frames):
+    for offset, frame in enumerate(frames):
+        marker.apply(frame, start + offset)
+    return frames
+
+
+def _map_chunks(marker, chunks, workers):
+    """
+    Watermark (start_index, frames) chunks on a thread pool
+
+    Yields each chunk's frames in order, with at most `workers` chunks in flight,
+    so memory stays bounded however many frames the source produces.
+    """
+    pending = deque()
+    with ThreadPoolExecutor(max_workers=workers, thread_name_prefix='frames') as pool:
+        for start, frames in chunks:
+            if len(pending) >= workers:
+                yield pending.popleft().result()
+            pending.append(pool.submit(_mark_chunk, marker, start, frames))
+        while pending:
+            yield pending.popleft().result()
+
+
+def watermark_animation(bot, input_path, output_path, add_invisible=True, add_visible=True,
+                        add_metadata=True, visible_text="© 2024", visible_positions=None, font_size=24,
+                        opacity=70, invisible_text="Protected", timestamp=None, keyframe_interval=1,
+                        frame_workers=None, chunk_frames=8, data=None):
+    """
+    Watermark every frame of an animated GIF, APNG or WebP
+
+    Frames are decoded one at a time and marked in parallel chunks. Pillow's GIF and
+    APNG encoders buffer the whole animation before writing, so the output frames are
+    held until the save. GIF output can't carry the invisible mark (frames are
+    re-quantised to a palette), WebP output is written lossless so it does.
+
+    Args:
+        bot (WatermarkBot): Configured bot
+        input_path (str): Path to the animation
+        output_path (str): Path to save to (extension follows the input format)
+        timestamp (datetime): Time stamped into the metadata
+        keyframe_interval (int): Embed the invisible mark on every Nth frame
+        frame_workers (int): Threads marking frames (default: CPU count)
+        chunk_frames (int): Frames per chunk handed to a thread
+        data (bytes): Contents of input_path if already read
+        Other arguments: Same as WatermarkBot.process_image
+
+    Returns:
+        tuple: (path written, number of frames, list of warnings)
+    """
+    warnings = []
+    with Image.open(io.BytesIO(data) if data is not None else input_path) as img:
+        fmt = img.format
+        if fmt not in ANIMATED_FORMATS:
+            raise ValueError(f"Unsupported animation format: {fmt}")
+        output_path = os.path.splitext(output_path)[0] + ANIMATED_FORMATS[fmt]
+        if add_invisible and fmt == 'GIF':
+            warnings.append("invisible watermark skipped: GIF frames are palette-quantised")
+            add_invisible = False
+        marker = FrameMarker(bot, img.size, add_invisible, add_visible, visible_text, visible_positions,
+                             font_size, opacity, invisible_text, keyframe_interval)
+        loop = img.info.get('loop', 0)
+        durations = []
+
+        def chunks():
+            batch = []
+            for index, frame in enumerate(ImageSequence.Iterator(img)):
+                batch.append(np.array(frame.convert('RGBA')))
+                durations.append(frame.info.get('duration', 100))
+                if len(batch) == chunk_frames:
+                    yield index + 1 - len(batch), batch
+                    batch = []
+            if batch:
+                yield len(durations) - len(batch), batch
+
+        frames = [Image.fromarray(frame)
+                  for chunk in _map_chunks(marker, chunks(), frame_workers or os.cpu_count() or 1)
+                  for frame in chunk]
+
+    save_kwargs = {'save_all': True, 'append_images': frames[1:], 'duration': durations, 'loop': loop}
+    if fmt == 'WEBP':
+        save_kwargs['lossless'] = True
+    if add_metadata:
+        if fmt == 'GIF':
+            save_kwargs['comment'] = f"© {timestamp.year} {bot.author_name} - {bot.website}"
+        else:
+            save_kwargs['exif'] = bot.build_exif(timestamp)
+    frames[0].save(output_path, format=fmt, **save_kwargs)
+    return output_path, len(frames), warnings
+
+
+def _require(tool):
+    path = shutil.which(tool)
+    if path is None:
+        raise RuntimeError(f"{tool} not found on PATH; install ffmpeg to watermark video")
+    return path
+
+
+def probe_video(input_path):
+    """
+    Read the size and frame rate of a video's first video stream with ffprobe
+
+    Returns:
+        tuple: (width, height, frame rate as ffmpeg's rational string, e.g. '30000/1001')
+    """
+    result = subprocess.run(
+        [_require('ffprobe'), '-v', 'error', '-select_streams', 'v:0',
+         '-show_entries', 'stream=width,height,r_frame_rate', '-of', 'json', input_path],
+        capture_output=True, text=True)
+    if result.returncode != 0:
+        raise ValueError(f"Could not read video from {input_path}: {result.stderr.strip()}")
+    streams = json.loads(result.stdout).get('streams')
+    if not streams:
+        raise ValueError(f"No video stream in {input_path}")
+    return streams[0]['width'], streams[0]['height'], streams[0]['r_frame_rate']
+
+
+def watermark_video(bot, input_path, output_path, add_invisible=True, add_visible=True, add_metadata=True,
+                    visible_text="© 2024", visible_positions=None, font_size=24, opacity=70,
+                    invisible_text="Protected", timestamp=None, keyframe_interval=1, frame_workers=None,
+                    chunk_frames=8, video_codec='libx264', crf=18):
+    """
+    Watermark a video by streaming raw frames through ffmpeg
+
+    One ffmpeg process decodes to raw RGB on a pipe, frames are marked in parallel
+    chunks, and a second ffmpeg process encodes them, copying the audio from the
+    input. The invisible mark lives in pixel LSBs, so it only survives lossless
+    codecs (see LOSSLESS_CODECS); marked frames are forced to be keyframes, and codecs
+    that are only lossless at one crf (see LOSSLESS_CRF) are run at it. With a lossy
+    codec the mark is skipped (embedding it would only force every marked frame to
+    be a keyframe for nothing) and a warning is returned instead.
+
+    Args:
+        bot (WatermarkBot): Configured bot
+        input_path (str): Path to the video
+        output_path (str): Path to save to (a non-video extension is replaced by the input's)
+        timestamp (datetime): Time stamped into the container metadata
+        keyframe_interval (int): Embed the invisible mark on every Nth frame
+        frame_workers (int): Threads marking frames (default: CPU count)
+        chunk_frames (int): Frames per chunk handed to a thread
+        video_codec (str): ffmpeg video encoder
+        crf (int): Constant rate factor for encoders that take one (None to omit)
+        Other arguments: Same as WatermarkBot.process_image
+
+    Returns:
+        tuple: (path written, number of frames, list of warnings)
+    """
+    ffmpeg = _require('ffmpeg')
+    width, height, rate = probe_video(input_path)
+    if os.path.splitext(output_path)[1].lower() not in VIDEO_EXTENSIONS:
+        output_path = os.path.splitext(output_path)[0] + os.path.splitext(input_path)[1].lower()
+    warnings = []
+    if add_invisible and video_codec not in LOSSLESS_CODECS:
+        warnings.append(f"invisible watermark skipped: {video_codec} is lossy "
+                        f"(use one of {', '.join(LOSSLESS_CODECS)} to keep it)")
+        add_invisible = False
+    if add_invisible and video_codec in LOSSLESS_CRF and crf != LOSSLESS_CRF[video_codec]:
+        requested = "the encoder's default" if crf is None else crf
+        warnings.append(f"encoded with {video_codec} at crf {LOSSLESS_CRF[video_codec]} instead of "
+                        f"{requested}, which would not keep the invisible watermark")
+        crf = LOSSLESS_CRF[video_codec]
+    marker = FrameMarker(bot, (width, height), add_invisible, add_visible, visible_text, visible_positions,
+                         font_size, opacity, invisible_text, keyframe_interval)
+
+    encode_cmd = [ffmpeg, '-v', 'error', '-y',
+                  '-f', 'rawvideo', '-pix_fmt', 'rgb24', '-s', f'{width}x{height}', '-r', rate, '-i', '-',
+                  '-i', input_path, '-map', '0:v:0', '-map', '1:a?', '-c:a', 'copy',
+                  '-c:v', video_codec, '-pix_fmt', LOSSLESS_CODECS.get(video_codec, 'yuv420p')]
+    if crf is not None and video_codec not in ('ffv1', 'png'):
+        encode_cmd += ['-crf', str(crf)]
+    if add_invisible:
+        encode_cmd += ['-force_key_frames', f'expr:eq(mod(n,{marker.keyframe_interval}),0)']
+    if add_metadata:
+        encode_cmd += ['-metadata', f'artist={bot.author_name}',
+                       '-metadata', f'copyright=© {timestamp.year} {bot.author_name}',
+                       '-metadata', f'comment=Website: {bot.website}']
+    encode_cmd.append(output_path)
+
+    # ffmpeg's messages go to temporary files: a pipe nobody reads until the end
+    # can fill up and stall a chatty decode
+    decoder_log, encoder_log = tempfile.TemporaryFile(), tempfile.TemporaryFile()
+    decoder = subprocess.Popen([ffmpeg, '-v', 'error', '-i', input_path, '-map', '0:v:0',
+                                '-f', 'rawvideo', '-pix_fmt', 'rgb24', '-'],
+                               stdout=subprocess.PIPE, stderr=decoder_log)
+    encoder = subprocess.Popen(encode_cmd, stdin=subprocess.PIPE, stderr=encoder_log)
+    frame_count = 0
+
+    def chunks():
+        start = 0
+        while True:
+            batch = []
+            while len(batch) < chunk_frames:
+                frame = np.empty((height, width, 3), dtype=np.uint8)
+                if decoder.stdout.readinto(frame.reshape(-1)) < frame.nbytes:
+                    break
+                batch.append(frame)
+            if batch:
+                yield start, batch
+                start += len(batch)
+            if len(batch) < chunk_frames:
+                return
+
+    try:
+        try:
+            for chunk in _map_chunks(marker, chunks(), frame_workers or os.cpu_count() or 1):
+                for frame in chunk:
+                    encoder.stdin.write(frame.data)
+                frame_count += len(chunk)
+            encoder.stdin.close()
+        except BrokenPipeError:
+            # The encoder exited early: stop decoding and report the encoder's own message
+            decoder.kill()
+            encoder.wait()
+            raise RuntimeError(f"ffmpeg failed to encode {output_path}: {_read_log(encoder_log)}")
+        if decoder.wait() != 0:
+            raise ValueError(f"Could not decode {input_path}: {_read_log(decoder_log)}")
+        if encoder.wait() != 0:
+            raise RuntimeError(f"ffmpeg failed to encode {output_path}: {_read_log(encoder_log)}")
+    finally:
+        for process in (decoder, encoder):
+            if process.poll() is None:
+                process.kill()
+                process.wait()
+        decoder_log.close()
+        encoder_log.close()
+    return output_path, frame_count, warnings
+
+
+def _read_log(log):
+    """Contents of an ffmpeg stderr log file"""
+    log.seek(0)
+    return log.read().decode(errors='replace').strip()
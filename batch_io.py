@@ -0,0 +1,120 @@
+#!/usr/bin/env python3
+"""
+Threaded I/O helpers for batch runs.
+Input files are read ahead and outputs written behind on a thread pool, so
+disk and network latency overlaps with watermarking instead of stalling it.
+File I/O and PNG compression release the GIL, so threads are enough here.
+"""
+
+import os
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+
+def _read_file(path):
+    with open(path, 'rb') as f:
+        return f.read()
+
+
+def _file_size(path):
+    """Size a read of path will buffer (0 if it can't be stat'ed; the read reports the error)"""
+    try:
+        return os.path.getsize(path)
+    except OSError:
+        return 0
+
+
+def prefetch_files(paths, depth=4, max_bytes=256 * 1024 * 1024, workers=4):
+    """
+    Read files ahead of the consumer on a thread pool
+
+    Args:
+        paths (list): Files to read, yielded in this order
+        depth (int): Maximum number of files read ahead of the consumer
+        max_bytes (int): Cap on the bytes buffered or being read ahead (each read reserves
+            its file's size when submitted)
+        workers (int): Reader threads
+
+    Yields:
+        tuple: (path, data, error) where data is None if the read failed
+    """
+    depth = max(1, depth)
+    pending = deque()
+    reserved = 0
+    next_index = 0
+    with ThreadPoolExecutor(max_workers=workers, thread_name_prefix='prefetch') as pool:
+        while next_index < len(paths) or pending:
+            # Always keep one read in flight, otherwise respect depth and memory cap
+            while next_index < len(paths):
+                path = paths[next_index]
+                size = _file_size(path)
+                if pending and (len(pending) >= depth or reserved + size > max_bytes):
+                    break
+                pending.append((path, size, pool.submit(_read_file, path)))
+                reserved += size
+                next_index += 1
+
+            path, size, future = pending.popleft()
+            reserved -= size
+            try:
+                yield path, future.result(), None
+            except Exception as e:
+                yield path, None, e
+
+
+class WriteBehindQueue:
+    def __init__(self, depth=4, max_bytes=512 * 1024 * 1024, workers=4):
+        """
+        Bounded queue of asynchronous write jobs
+
+        Args:
+            depth (int): Maximum number of writes in flight
+            max_bytes (int): Maximum estimated bytes held by writes in flight
+            workers (int): Writer threads
+        """
+        self.depth = max(1, depth)
+        self.max_bytes = max_bytes
+        self.pool = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='write-behind')
+        self.pending = deque()
+        self.pending_bytes = 0
+
+    def submit(self, key, nbytes, fn, *args, **kwargs):
+        """
+        Queue fn(*args, **kwargs), blocking while the queue is full
+
+        Args:
+            key: Identifies the job in the completed results
+            nbytes (int): Memory held by the job until it finishes
+
+        Returns:
+            list: (key, result, error) for jobs that had to finish to make room
+        """
+        done = []
+        while self.pending and (len(self.pending) >= self.depth or
+                                self.pending_bytes + nbytes > self.max_bytes):
+            done.append(self._reap_oldest())
+        self.pending.append((key, nbytes, self.pool.submit(fn, *args, **kwargs)))
+        self.pending_bytes += nbytes
+        # Collect anything else that has already finished without waiting
+        while self.pending and self.pending[0][2].done():
+            done.append(self._reap_oldest())
+        return done
+
+    def _reap_oldest(self):
+        key, nbytes, future = self.pending.popleft()
+        self.pending_bytes -= nbytes
+        try:
+            return key, future.result(), None
+        except Exception as e:
+            return key, None, e
+
+    def drain(self):
+        """
+        Wait for all queued writes and shut the pool down
+
+        Returns:
+            list: (key, result, error) for the remaining jobs
+        """
+        done = [self._reap_oldest() for _ in range(len(self.pending))]
+        self.pool.shutdown()
+        return done
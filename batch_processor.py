@@ -5,84 +5,406 @@ This script processes all images in a directory and saves them to an output dire
 """
 
 import os
+import sys
+import time
 import glob
-from watermark_bot import WatermarkBot
+from watermark_bot import WatermarkBot, parse_renditions, resolve_timestamp_mode, motion_options
+from animated_watermark import VIDEO_EXTENSIONS, motion_kind
+from output_cache import OutputCache
+from frame_pipeline import run_pipeline
+from batch_io import prefetch_files, WriteBehindQueue
+from composite import BACKENDS
+from batch_report import BatchReport, ImageResult, load_failures, retry_call
+from work_queue import LeaseKeeper, LeaseQueue, default_worker_id, parse_shard, shard_of
 import argparse
+from datetime import datetime
+
+def _read_bytes(path):
+    with open(path, 'rb') as f:
+        return f.read()
 
 class BatchWatermarkProcessor:
-    def __init__(self, author_name="Your Name", website="your-website.com"):
-        self.bot = WatermarkBot(author_name=author_name, website=website)
-        self.supported_formats = ['.jpg', '.jpeg', '.png', '.bmp', '.tiff']
+    def __init__(self, author_name="Your Name", website="your-website.com", timestamp=None,
+                 watermark_key=None, ecc_symbols=0, composite_backend='pillow', composite_threads=None):
+        self.bot = WatermarkBot(author_name=author_name, website=website, timestamp=timestamp,
+                                watermark_key=watermark_key, ecc_symbols=ecc_symbols,
+                                composite_backend=composite_backend,
+                                composite_threads=composite_threads)
+        self.supported_formats = ['.jpg', '.jpeg', '.png', '.bmp', '.tiff', '.gif', '.webp'] + list(VIDEO_EXTENSIONS)
         
-    def get_image_files(self, input_dir):
-        """Get all supported image files from input directory"""
+    def get_image_files(self, input_dir, include=None):
+        """
+        Get all supported image files from input directory
+
+        Args:
+            input_dir (str): Directory to search
+            include (set): Only return these absolute paths (e.g. failures from a report)
+        """
         image_files = []
         for ext in self.supported_formats:
             image_files.extend(glob.glob(os.path.join(input_dir, f"*{ext}")))
             image_files.extend(glob.glob(os.path.join(input_dir, f"*{ext.upper()}")))
+        if include is not None:
+            image_files = [path for path in image_files if os.path.abspath(path) in include]
         return image_files
     
-    def process_directory(self, input_dir, output_dir, mark_postfix, **kwargs):
+    def split_motion_files(self, files):
+        """
+        Separate videos from images by extension
+
+        Animations go with the images: they are recognised once their bytes have been
+        read (see animated_watermark.motion_kind), so no file is opened here.
+
+        Returns:
+            tuple: (list of (path, 'video') for videos, list of image paths)
+        """
+        motion = []
+        stills = []
+        for path in files:
+            if motion_kind(path) == 'video':
+                motion.append((path, 'video'))
+            else:
+                stills.append(path)
+        return motion, stills
+    
+    def process_motion_files(self, motion_files, output_dir, mark_postfix, motion_options=None, **kwargs):
+        """
+        Watermark videos one after another (each one's frames are marked in parallel)
+
+        Yields:
+            ImageResult: One per file
+        """
+        for path, kind in motion_files:
+            filename = os.path.basename(path)
+            name, ext = os.path.splitext(filename)
+            result = ImageResult(path, os.path.join(output_dir, f"{name}{mark_postfix}{ext}"))
+            print(f"Processing {kind}: {filename}")
+            try:
+                with result.timed('process'):
+                    result.output_path, _, result.warnings = self.bot.process_motion(
+                        kind, path, result.output_path, motion_options=motion_options, **kwargs)
+                result.input_bytes = os.path.getsize(path)
+                result.record_outputs([result.output_path])
+            except Exception as e:
+                result.fail(e)
+            yield result
+    
+    def _print_result(self, report, result, progress=""):
+        """Record a result in the report and print its status line"""
+        report.record(result)
+        filename = os.path.basename(result.input_path)
+        if result.status == 'cached':
+            print(f"✓ {progress}Successfully processed: {filename} (cached)")
+        elif result.ok:
+            print(f"✓ {progress}Successfully processed: {filename}")
+        else:
+            print(f"✗ {progress}Failed to process {filename}: {result.error_type}: {result.error}")
+        for warning in result.warnings:
+            print(f"  Note: {warning}")
+    
+    def _print_summary(self, report, output_dir):
+        print(f"\n{'='*50}")
+        print(f"Batch processing completed!")
+        print(f"Successful: {report.successful}")
+        print(f"Failed: {report.failed}")
+        print(f"Output directory: {output_dir}")
+        if report.path:
+            print(f"Report: {report.path}")
+        print(f"{'='*50}")
+    
+    def process_directory(self, input_dir, output_dir, mark_postfix, prefetch=4, write_behind=4,
+                          io_workers=4, io_buffer_mb=512, cache=None, motion_options=None,
+                          report_path=None, retries=2, include=None, **kwargs):
         """
         Process all images in input directory and save to output directory
         Args:
             input_dir (str): Input directory path
             output_dir (str): Output directory path
             mark_postfix (str): Postfix to add to marked images
-            **kwargs: Arguments to pass to process_image method
+            prefetch (int): Number of input files read ahead on I/O threads
+            write_behind (int): Number of outputs written asynchronously on I/O threads
+            io_workers (int): Threads used for each of reading and writing
+            io_buffer_mb (int): Memory cap in MiB for each of read-ahead and write-behind buffers
+            cache (OutputCache): Serve repeated requests from, and store results in, this cache
+            motion_options (dict): Extra arguments for animations and video (see WatermarkBot.process_image)
+            report_path (str): JSONL file to append one result per image to
+            retries (int): Times to retry reading and writing a file on transient I/O errors
+            include (set): Only process these absolute input paths (see batch_report.load_failures)
+            **kwargs: Watermark arguments of WatermarkBot.process_image (add_invisible,
+                visible_text, renditions, preview_only, ...)
+
+        Returns:
+            tuple: (number of images processed, number failed)
         """
         # Create output directory if it doesn't exist
         os.makedirs(output_dir, exist_ok=True)
         
         # Get all image files
-        image_files = self.get_image_files(input_dir)
+        image_files = self.get_image_files(input_dir, include)
         
         if not image_files:
             print(f"No supported image files found in {input_dir}")
-            return
+            return 0, 0
         
         print(f"Found {len(image_files)} images to process")
+        motion_files, image_files = self.split_motion_files(image_files)
         
-        # Process each image
-        successful = 0
-        failed = 0
+        # Metadata and renditions are applied by the encoder, everything else by the pixel stages
+        add_metadata = kwargs.pop('add_metadata', True)
+        renditions = kwargs.pop('renditions', None)
+        preview_only = kwargs.pop('preview_only', False)
+        io_buffer_bytes = io_buffer_mb * 1024 * 1024
         
-        for i, image_path in enumerate(image_files, 1):
-            try:
+        with BatchReport(report_path) as report:
+            def record(done):
+                for result, _, error in done:
+                    if error is not None:
+                        result.fail(error)
+                    self._print_result(report, result)
+            
+            if preview_only or self.bot.copies_unchanged(add_metadata=add_metadata, renditions=renditions, **kwargs):
+                # No frames to render, so videos are treated like any other file, as process_image does
+                image_files += [path for path, _ in motion_files]
+                motion_files = []
+            for result in self.process_motion_files(motion_files, output_dir, mark_postfix, motion_options,
+                                                    add_metadata=add_metadata, **kwargs):
+                self._print_result(report, result)
+            
+            writer = WriteBehindQueue(depth=write_behind, max_bytes=io_buffer_bytes, workers=io_workers)
+            reads = prefetch_files(image_files, depth=prefetch, max_bytes=io_buffer_bytes, workers=io_workers)
+            
+            for i, (image_path, data, read_error) in enumerate(reads, 1):
                 # Generate output filename
                 filename = os.path.basename(image_path)
                 name, ext = os.path.splitext(filename)
                 output_filename = f"{name}{mark_postfix}{ext}"
-                output_path = os.path.join(output_dir, output_filename)
+                result = ImageResult(image_path, os.path.join(output_dir, output_filename))
                 
                 print(f"Processing {i}/{len(image_files)}: {filename}")
                 
-                # Process the image
-                self.bot.process_image(
-                    input_path=image_path,
-                    output_path=output_path,
-                    **kwargs
-                )
-                
-                successful += 1
-                print(f"✓ Successfully processed: {filename}")
+                try:
+                    if read_error is not None:
+                        # The read-ahead attempt counts as the first try
+                        with result.timed('read'):
+                            data = retry_call(lambda: _read_bytes(image_path), result, retries,
+                                              failed_attempt=read_error)
+                    # Frames of animations are marked in parallel on the animation's own thread pool
+                    job = self.bot.start_job(result, data, cache=cache, motion_options=motion_options,
+                                             retries=retries, add_metadata=add_metadata, renditions=renditions,
+                                             preview_only=preview_only, **kwargs)
+                    if job is None:
+                        record([(result, None, None)])
+                        continue
+                    
+                    # Process the image; the PNG encode and write happen on a writer thread
+                    timestamp, cache_key = job
+                    with result.timed('process'):
+                        img = self.bot.load_image(image_path, data)
+                        img = self.bot.watermark_frame(img, **kwargs)
+                    nbytes = img.width * img.height * len(img.getbands())
+                    record(writer.submit(result, nbytes, self.bot.finish_job, result, img, timestamp,
+                                         cache=cache, cache_key=cache_key, add_metadata=add_metadata,
+                                         renditions=renditions, retries=retries))
+                    
+                except Exception as e:
+                    record([(result, None, e)])
+            
+            record(writer.drain())
+            
+            # Print summary
+            self._print_summary(report, output_dir)
+        return report.successful + report.failed, report.failed
+
+    def process_directory_pipelined(self, input_dir, output_dir, mark_postfix, decode_workers=1,
+                                    process_workers=None, encode_workers=None, slots=None,
+                                    slot_mb=128, cache=None, motion_options=None, report_path=None,
+                                    retries=2, include=None, **kwargs):
+        """
+        Process all images in input directory using the staged multi-process pipeline
+        Args:
+            input_dir (str): Input directory path
+            output_dir (str): Output directory path
+            mark_postfix (str): Postfix to add to marked images
+            decode_workers (int): Processes decoding input files
+            process_workers (int): Processes applying the watermarks (default: CPU count)
+            encode_workers (int): Processes compressing PNG output (default: half the CPU count)
+            slots (int): Number of shared-memory frame buffers
+            slot_mb (int): Size of each frame buffer in MiB
+            cache (OutputCache): Serve repeated requests from, and store results in, this cache
+            motion_options (dict): Extra arguments for animations and video (see WatermarkBot.process_image)
+            report_path (str): JSONL file to append one result per image to
+            retries (int): Times to retry reading and writing a file on transient I/O errors
+            include (set): Only process these absolute input paths (see batch_report.load_failures)
+            **kwargs: Watermark arguments of WatermarkBot.process_image, except preview_only
+
+        Returns:
+            tuple: (number of images processed, number failed)
+        """
+        # Create output directory if it doesn't exist
+        os.makedirs(output_dir, exist_ok=True)
+        
+        # Get all image files
+        image_files = self.get_image_files(input_dir, include)
+        
+        if not image_files:
+            print(f"No supported image files found in {input_dir}")
+            return 0, 0
+        
+        print(f"Found {len(image_files)} images to process")
+        motion_files, image_files = self.split_motion_files(image_files)
+        if self.bot.copies_unchanged(**kwargs):
+            # Nothing to render, so videos are copied like any other file
+            image_files += [path for path, _ in motion_files]
+            motion_files = []
+        
+        jobs = []
+        for image_path in image_files:
+            name, ext = os.path.splitext(os.path.basename(image_path))
+            jobs.append((image_path, os.path.join(output_dir, f"{name}{mark_postfix}{ext}")))
+        
+        with BatchReport(report_path) as report:
+            # Videos stream their frames through their own thread pool
+            motion_kwargs = {k: v for k, v in kwargs.items() if k != 'renditions'}
+            for result in self.process_motion_files(motion_files, output_dir, mark_postfix,
+                                                    motion_options, **motion_kwargs):
+                self._print_result(report, result)
+            
+            results = run_pipeline(self.bot, jobs, decode_workers=decode_workers,
+                                   process_workers=process_workers, encode_workers=encode_workers,
+                                   slots=slots, slot_mb=slot_mb, cache=cache, retries=retries,
+                                   motion_options=motion_options, **kwargs)
+            for i, result in enumerate(results, 1):
+                self._print_result(report, result, f"[{i}/{len(jobs)}] ")
+            
+            # Print summary
+            self._print_summary(report, output_dir)
+        return report.successful + report.failed, report.failed
+
+    def process_queue(self, input_dir, output_dir, mark_postfix, queue, worker_id=None, lease_batch=8,
+                      poll_interval=5.0, report_path=None, include=None, requeue_failed=False, **kwargs):
+        """
+        Pull images from a shared lease queue until every job is finished
+
+        Any number of workers, on this machine or on others sharing the volume, can run
+        this against the same queue at once. Each one adds the inputs it finds (jobs
+        already queued are skipped), then leases a few jobs at a time; jobs of a worker
+        that dies are taken over once their lease expires.
+        Args:
+            input_dir (str): Input directory path
+            output_dir (str): Output directory path
+            mark_postfix (str): Postfix to add to marked images
+            queue (work_queue.LeaseQueue): Shared job queue
+            worker_id (str): Name of this worker in the queue (default: host:pid)
+            lease_batch (int): Jobs leased at a time
+            poll_interval (float): Seconds between checks for expired leases while other
+                workers finish their last jobs
+            report_path (str): JSONL file to append one result per image to
+            include (set): Only queue these absolute input paths (e.g. one shard)
+            requeue_failed (bool): Reset the included jobs that already failed in the queue, so
+                they run again with fresh attempts (for --rerun-failures)
+            **kwargs: Arguments to pass to process_image method
+
+        Returns:
+            tuple: (number of images this worker processed, number failed)
+        """
+        os.makedirs(output_dir, exist_ok=True)
+        worker_id = worker_id or default_worker_id()
+        
+        # Jobs are named relative to input_dir, so nodes may mount the volume at different paths
+        image_files = self.get_image_files(input_dir, include)
+        names = sorted(os.path.basename(path) for path in image_files)
+        added = queue.enqueue(names)
+        print(f"Worker {worker_id}: found {len(image_files)} images, {added} newly queued")
+        if requeue_failed:
+            print(f"Worker {worker_id}: {queue.requeue(names)} failed jobs queued again")
+        
+        with BatchReport(report_path) as report, LeaseKeeper(queue, worker_id) as keeper:
+            while True:
+                names = queue.lease(worker_id, lease_batch)
+                if not names:
+                    if not queue.outstanding():
+                        break
+                    # Other workers still hold leases; wait in case one of them dies
+                    time.sleep(poll_interval)
+                    continue
                 
+                for i, name in enumerate(names):
+                    keeper.hold(names[i:])
+                    try:
+                        stem, ext = os.path.splitext(name)
+                        result = self.bot.process_image(
+                            os.path.join(input_dir, name),
+                            os.path.join(output_dir, f"{stem}{mark_postfix}{ext}"), **kwargs)
+                    except BaseException:
+                        # Interrupted: give the jobs not yet done back to the other workers
+                        queue.release(worker_id, names[i:])
+                        raise
+                    queue.complete(worker_id, name, None if result.ok else f"{result.error_type}: {result.error}")
+                    self._print_result(report, result)
+                keeper.hold([])
+            
+            counts = queue.counts()
+            print(f"\n{'='*50}")
+            print(f"Worker {worker_id} finished, queue drained!")
+            print(f"Processed by this worker: {report.successful} successful, {report.failed} failed")
+            print(f"Whole queue: {counts.get('done', 0)} done, {counts.get('failed', 0)} failed")
+            print(f"Output directory: {output_dir}")
+            print(f"{'='*50}")
+        return report.successful + report.failed, report.failed
+
+    def verify_directory(self, input_dir, watermark_text=None, search_offsets=False, prefetch=4, io_workers=4):
+        """
+        Check the invisible watermark of every image in a directory
+        Args:
+            input_dir (str): Directory of watermarked images
+            watermark_text (str): Expected text, or None to accept any valid mark
+            search_offsets (bool): Also accept marks in cropped images (slower)
+            prefetch (int): Number of files read ahead on I/O threads
+            io_workers (int): Reader threads
+
+        Returns:
+            tuple: (number of images accepted, number rejected)
+        """
+        # Video marks are checked on extracted frames, not on the containers
+        image_files = [path for path in self.get_image_files(input_dir)
+                       if os.path.splitext(path)[1].lower() not in VIDEO_EXTENSIONS]
+        
+        if not image_files:
+            print(f"No supported image files found in {input_dir}")
+            return 0, 0
+        
+        accepted = 0
+        rejected = 0
+        
+        for image_path, data, read_error in prefetch_files(image_files, depth=prefetch, workers=io_workers):
+            filename = os.path.basename(image_path)
+            try:
+                if read_error is not None:
+                    raise read_error
+                ok = self.bot.verify_invisible(self.bot.load_image(image_path, data), watermark_text,
+                                               search_offsets=search_offsets)
             except Exception as e:
-                failed += 1
-                print(f"✗ Failed to process {filename}: {str(e)}")
+                ok = False
+                print(f"✗ Could not check {filename}: {str(e)}")
+            else:
+                print(f"{'✓' if ok else '✗'} {filename}")
+            if ok:
+                accepted += 1
+            else:
+                rejected += 1
         
         # Print summary
         print(f"\n{'='*50}")
-        print(f"Batch processing completed!")
-        print(f"Successful: {successful}")
-        print(f"Failed: {failed}")
-        print(f"Output directory: {output_dir}")
+        print(f"Verification completed!")
+        print(f"Accepted: {accepted}")
+        print(f"Rejected: {rejected}")
         print(f"{'='*50}")
+        return accepted, rejected
 
 def main():
     parser = argparse.ArgumentParser(description='Batch watermark processor (directory version of watermark_bot.py)')
     parser.add_argument('--input_dir', required=True, help='Input directory containing images')
-    parser.add_argument('--output_dir', required=True, help='Output directory for processed images')
+    parser.add_argument('--output_dir', help='Output directory for processed images')
     parser.add_argument('--mark_postfix', default='_watermarked', help='Postfix to add to marked images (default: _watermarked)')
     parser.add_argument('--author', default='Your Name', help='Author name for metadata')
     parser.add_argument('--website', default='your-website.com', help='Website for metadata')
@@ -90,6 +412,11 @@ def main():
     parser.add_argument('--no-visible', action='store_true', help='Skip visible watermark')
     parser.add_argument('--no-metadata', action='store_true', help='Skip metadata')
     parser.add_argument('--visible-text', default='© 2024', help='Text for visible watermark')
+    parser.add_argument('--invisible-text', default='Protected', help='Text to embed as invisible watermark')
+    parser.add_argument('--watermark-key', default=None, help='Secret deciding where invisible watermark bits are placed (needed again to verify them)')
+    parser.add_argument('--ecc', type=int, default=0, help='Reed-Solomon parity bytes per block for the invisible watermark (default: 0, needs reedsolo)')
+    parser.add_argument('--verify', action='store_true', help='Check the invisible watermark of the images in --input_dir against --invisible-text instead of watermarking them')
+    parser.add_argument('--allow-crops', action='store_true', help='With --verify, also accept marks in cropped images')
     parser.add_argument('--top-left', action='store_true', help='Add watermark to top-left position')
     parser.add_argument('--top-right', action='store_true', help='Add watermark to top-right position')
     parser.add_argument('--bottom-left', action='store_true', help='Add watermark to bottom-left position')
@@ -97,6 +424,34 @@ def main():
     parser.add_argument('--center', action='store_true', help='Add watermark to center position')
     parser.add_argument('--font-size', type=int, default=24, help='Font size for visible watermark')
     parser.add_argument('--opacity', type=int, default=70, help='Opacity percentage for visible watermark (0-100)')
+    parser.add_argument('--deterministic', action='store_true', help='Derive metadata timestamps from the inputs (EXIF date or modification time) so re-runs give identical files')
+    parser.add_argument('--timestamp', type=datetime.fromisoformat, default=None, help='Fixed metadata timestamp, e.g. "2024-01-01 00:00:00" (implies reproducible output)')
+    parser.add_argument('--cache-dir', default=None, help='Serve repeated requests from a content-addressed output cache in this directory')
+    parser.add_argument('--cache-mb', type=int, default=1024, help='Size limit of the output cache in MiB (default: 1024)')
+    parser.add_argument('--renditions', type=parse_renditions, default=None, help='Comma-separated max edge sizes of downscaled copies to save alongside each output, e.g. 1920,640')
+    parser.add_argument('--composite-backend', choices=BACKENDS, default='pillow', help='How the visible watermark is blended: pillow (full-frame overlay) or opencv (text regions only, multithreaded); output is identical (default: pillow)')
+    parser.add_argument('--composite-threads', type=int, default=None, help='OpenCV threads per process for --composite-backend opencv (default: OpenCV decides)')
+    parser.add_argument('--report', default=None, help='Append one JSON line per image (status, timings, sizes, error) to this file')
+    parser.add_argument('--retries', type=int, default=2, help='Retries for transient I/O errors when reading and writing files (default: 2)')
+    parser.add_argument('--rerun-failures', metavar='REPORT', default=None, help='Only process the images whose latest entry in this report failed; results are appended to it unless --report is given')
+    parser.add_argument('--shard', type=parse_shard, default=None, help='Only process shard i of N (e.g. 0/4), partitioned by a hash of each file name, to split a run over N machines')
+    parser.add_argument('--queue', metavar='DB', default=None, help='Pull work from a shared SQLite lease queue (created if missing) instead of processing the directory in order; run any number of workers against the same file')
+    parser.add_argument('--worker-id', default=None, help='Name of this worker in the --queue (default: host:pid)')
+    parser.add_argument('--lease-seconds', type=float, default=300, help='How long a --queue job stays reserved for a worker that stops renewing it (default: 300)')
+    parser.add_argument('--lease-batch', type=int, default=8, help='Jobs leased from the --queue at a time (default: 8)')
+    parser.add_argument('--prefetch', type=int, default=4, help='Input files to read ahead on I/O threads (default: 4)')
+    parser.add_argument('--write-behind', type=int, default=4, help='Outputs to write asynchronously on I/O threads (default: 4)')
+    parser.add_argument('--io-workers', type=int, default=4, help='Threads for each of reading and writing (default: 4)')
+    parser.add_argument('--io-buffer-mb', type=int, default=512, help='Memory cap in MiB for read-ahead and for write-behind buffers (default: 512)')
+    parser.add_argument('--pipeline', action='store_true', help='Run decode, watermark and encode stages in parallel worker processes')
+    parser.add_argument('--decode-workers', type=int, default=1, help='Decode processes in --pipeline mode (default: 1)')
+    parser.add_argument('--process-workers', type=int, default=None, help='Watermarking processes in --pipeline mode (default: CPU count)')
+    parser.add_argument('--encode-workers', type=int, default=None, help='PNG encoding processes in --pipeline mode (default: half the CPU count)')
+    parser.add_argument('--keyframe-interval', type=int, default=1, help='For animations and video, embed the invisible watermark on every Nth frame (default: 1)')
+    parser.add_argument('--frame-workers', type=int, default=None, help='Threads watermarking animation and video frames (default: CPU count)')
+    parser.add_argument('--video-codec', default='libx264', help='ffmpeg encoder for video output; the invisible watermark needs a lossless one such as ffv1, or libx264rgb (always run at crf 0 while the invisible watermark is on) (default: libx264)')
+    parser.add_argument('--crf', type=int, default=18, help='Constant rate factor for the video encoder; libx264rgb is only lossless at 0 (default: 18)')
+    parser.add_argument('--slot-mb', type=int, default=128, help='Size of each shared-memory frame buffer in MiB (default: 128)')
 
     args = parser.parse_args()
 
@@ -104,12 +459,31 @@ def main():
     if not os.path.isdir(args.input_dir):
         print(f"Error: Input directory '{args.input_dir}' does not exist")
         return
+    if not args.verify and not args.output_dir:
+        parser.error("--output_dir is required unless --verify is given")
 
     # Create batch processor
     processor = BatchWatermarkProcessor(
         author_name=args.author,
-        website=args.website
+        website=args.website,
+        timestamp=resolve_timestamp_mode(args),
+        watermark_key=args.watermark_key,
+        ecc_symbols=args.ecc,
+        composite_backend=args.composite_backend,
+        composite_threads=args.composite_threads
     )
+    
+    if args.verify:
+        _, rejected = processor.verify_directory(args.input_dir, watermark_text=args.invisible_text,
+                                                 search_offsets=args.allow_crops,
+                                                 prefetch=args.prefetch, io_workers=args.io_workers)
+        sys.exit(1 if rejected else 0)
+    
+    cache = None
+    if args.cache_dir:
+        if not processor.bot.deterministic and not args.no_metadata:
+            parser.error("--cache-dir needs --deterministic or --timestamp when metadata is added")
+        cache = OutputCache(args.cache_dir, max_bytes=args.cache_mb * 1024 * 1024)
 
     # Build positions list from command line arguments
     positions = []
@@ -127,19 +501,80 @@ def main():
     if not positions:
         positions = ['bottom-right']
 
-    # Process directory
-    processor.process_directory(
-        input_dir=args.input_dir,
-        output_dir=args.output_dir,
-        mark_postfix=args.mark_postfix,
+    include = None
+    if args.rerun_failures:
+        include = load_failures(args.rerun_failures)
+        print(f"Re-running {len(include)} failed images from {args.rerun_failures}")
+        if not include:
+            return
+        if args.report is None:
+            args.report = args.rerun_failures
+
+    if args.shard is not None:
+        index, count = args.shard
+        shard_files = {os.path.abspath(path) for path in processor.get_image_files(args.input_dir, include)
+                       if shard_of(path, count) == index}
+        print(f"Shard {index}/{count}: {len(shard_files)} images")
+        include = shard_files
+
+    options = dict(
         add_invisible=not args.no_invisible,
         add_visible=not args.no_visible,
         add_metadata=not args.no_metadata,
         visible_text=args.visible_text,
         visible_positions=positions,
         font_size=args.font_size,
-        opacity=args.opacity
+        opacity=args.opacity,
+        renditions=args.renditions,
+        cache=cache,
+        invisible_text=args.invisible_text,
+        motion_options=motion_options(args),
+        report_path=args.report,
+        retries=args.retries,
+        include=include
     )
 
+    # Process directory
+    if args.queue:
+        if args.pipeline:
+            parser.error("--queue and --pipeline can't be combined; run several --queue workers instead")
+        queue = LeaseQueue(args.queue, lease_seconds=args.lease_seconds)
+        try:
+            _, failed = processor.process_queue(
+                input_dir=args.input_dir,
+                output_dir=args.output_dir,
+                mark_postfix=args.mark_postfix,
+                queue=queue,
+                worker_id=args.worker_id,
+                lease_batch=args.lease_batch,
+                requeue_failed=args.rerun_failures is not None,
+                **options
+            )
+        finally:
+            queue.close()
+    elif args.pipeline:
+        _, failed = processor.process_directory_pipelined(
+            input_dir=args.input_dir,
+            output_dir=args.output_dir,
+            mark_postfix=args.mark_postfix,
+            decode_workers=args.decode_workers,
+            process_workers=args.process_workers,
+            encode_workers=args.encode_workers,
+            slot_mb=args.slot_mb,
+            **options
+        )
+    else:
+        _, failed = processor.process_directory(
+            input_dir=args.input_dir,
+            output_dir=args.output_dir,
+            mark_postfix=args.mark_postfix,
+            prefetch=args.prefetch,
+            write_behind=args.write_behind,
+            io_workers=args.io_workers,
+            io_buffer_mb=args.io_buffer_mb,
+            **options
+        )
+    sys.exit(1 if failed else 0)
+
 if __name__ == "__main__":
-    main() 
\ No newline at end of file
+    main()
@@ -0,0 +1,185 @@
+#!/usr/bin/env python3
+"""
+Per-image results and JSONL batch reports.
+Every processed input produces an ImageResult (status, stage timings, byte
+counts, error class and message) instead of a print line. Batch runs stream
+the results to a JSONL report, one object per line, which can be grepped,
+loaded for analysis, or fed back in to re-run just the failures. Transient
+I/O errors are retried with exponential backoff before an image is failed.
+"""
+
+import contextlib
+import errno
+import json
+import os
+import time
+from datetime import datetime
+
+# OSError codes where the same call can succeed a moment later (busy files, flaky network shares)
+TRANSIENT_ERRNOS = {errno.EAGAIN, errno.EBUSY, errno.EINTR, errno.EIO, errno.ETIMEDOUT,
+                    errno.ESTALE, errno.ECONNRESET, errno.ENFILE, errno.EMFILE}
+
+
+def is_transient(error):
+    """Whether an error is a transient I/O failure worth retrying"""
+    if isinstance(error, (TimeoutError, ConnectionError, InterruptedError, BlockingIOError)):
+        return True
+    return isinstance(error, OSError) and error.errno in TRANSIENT_ERRNOS
+
+
+def retry_call(fn, result=None, retries=2, backoff=0.5, failed_attempt=None):
+    """
+    Call fn(), retrying transient I/O errors with exponential backoff
+
+    Args:
+        fn (callable): Function taking no arguments
+        result (ImageResult): Result whose retry count is increased on every retry
+        retries (int): Maximum number of retries
+        backoff (float): Seconds to wait before the first retry, doubled for each further one
+        failed_attempt (Exception): Error of an attempt already made elsewhere (e.g. on a
+            read-ahead thread), counted as the first try
+
+    Returns:
+        The return value of fn; the last error is raised if every attempt fails
+    """
+    error = failed_attempt
+    tries = 0 if error is None else 1
+    while True:
+        if error is not None:
+            if tries > retries or not is_transient(error):
+                raise error
+            if result is not None:
+                result.retries += 1
+            time.sleep(backoff * 2 ** (tries - 1))
+        try:
+            return fn()
+        except Exception as e:
+            error = e
+            tries += 1
+
+
+class ImageResult:
+    def __init__(self, input_path, output_path=None):
+        """
+        Outcome of processing one input
+
+        Args:
+            input_path (str): Input file (stored absolute, so a report can be re-run from any directory)
+            output_path (str): Requested output path (updated to the path actually written)
+        """
+        self.input_path = os.path.abspath(input_path)
+        self.output_path = output_path
+        self.status = 'ok'
+        self.error_type = None
+        self.error = None
+        self.retries = 0
+        self.timings = {}
+        self.input_bytes = None
+        self.output_bytes = None
+        # Processed, but not entirely as asked (e.g. the invisible mark was skipped)
+        self.warnings = []
+
+    @property
+    def ok(self):
+        return self.status != 'failed'
+
+    def fail(self, error):
+        """Mark the result failed with an exception (or message) and return it"""
+        self.status = 'failed'
+        self.error_type = type(error).__name__ if isinstance(error, BaseException) else None
+        self.error = str(error)
+        return self
+
+    @contextlib.contextmanager
+    def timed(self, stage):
+        """Add the time spent in the with-block to timings[stage], in milliseconds"""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            elapsed = 1000.0 * (time.perf_counter() - start)
+            self.timings[stage] = round(self.timings.get(stage, 0.0) + elapsed, 3)
+
+    def record_outputs(self, paths):
+        """Set output_bytes from the files written"""
+        self.output_bytes = sum(os.path.getsize(path) for path in paths if os.path.isfile(path))
+
+    def to_dict(self):
+        return {
+            'input': self.input_path,
+            'output': self.output_path,
+            'status': self.status,
+            'error_type': self.error_type,
+            'error': self.error,
+            'retries': self.retries,
+            'timings_ms': self.timings,
+            'input_bytes': self.input_bytes,
+            'output_bytes': self.output_bytes,
+            'warnings': self.warnings,
+        }
+
+
+class BatchReport:
+    def __init__(self, path=None):
+        """
+        Collect results of a batch run, optionally streaming them to a JSONL file
+
+        Args:
+            path (str): Report file, appended to (None keeps counts only)
+        """
+        self.path = path
+        self.successful = 0
+        self.failed = 0
+        self.cached = 0
+        self._file = open(path, 'a', encoding='utf-8') if path else None
+
+    def record(self, result):
+        """Count a result and append it to the report"""
+        if result.status == 'failed':
+            self.failed += 1
+        else:
+            self.successful += 1
+            if result.status == 'cached':
+                self.cached += 1
+        if self._file is not None:
+            entry = dict(result.to_dict(), finished_at=datetime.now().isoformat(timespec='seconds'))
+            self._file.write(json.dumps(entry, ensure_ascii=False) + '\n')
+            # Flush per line so the report survives a crash mid-batch
+            self._file.flush()
+
+    def close(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+def load_failures(path):
+    """
+    Inputs whose most recent entry in a JSONL report is a failure
+
+    Args:
+        path (str): Report written by BatchReport
+
+    Returns:
+        set: Absolute input paths to re-run
+    """
+    latest = {}
+    with open(path, encoding='utf-8') as f:
+        for line_number, line in enumerate(f, 1):
+            if not line.strip():
+                continue
+            try:
+                entry = json.loads(line)
+            except json.JSONDecodeError:
+                # A run killed mid-write can leave a truncated last line
+                print(f"Skipping unreadable report line {line_number} in {path}")
+                continue
+            # Inputs are recorded absolute; abspath only normalises the path
+            latest[os.path.abspath(entry['input'])] = entry['status']
+    return {path for path, status in latest.items() if status == 'failed'}
@@ -0,0 +1,352 @@
+#!/usr/bin/env python3
+"""
+Staged multi-process pipeline for batch watermarking.
+Decoding, pixel work and PNG encoding run in separate worker processes and
+hand frames to each other through a recycled pool of shared-memory buffers,
+so large frames are never pickled between stages.
+"""
+
+import multiprocessing as mp
+import queue
+from multiprocessing import shared_memory
+
+import numpy as np
+from PIL import Image
+
+from batch_report import ImageResult, retry_call
+
+# Modes that round-trip through a flat numpy buffer without conversion
+SHAREABLE_MODES = ('L', 'LA', 'P', 'RGB', 'RGBA', 'I', 'I;16', 'CMYK')
+
+# Image info carried between stages with the pixels: what the PNG encoder
+# reads from Image.info (see WatermarkBot.save_image)
+FRAME_INFO_KEYS = ('transparency', 'icc_profile')
+
+
+class SharedFramePool:
+    def __init__(self, slots, slot_bytes):
+        """
+        Allocate a fixed pool of shared-memory frame buffers
+
+        Args:
+            slots (int): Number of buffers (bounds the frames in flight)
+            slot_bytes (int): Size of each buffer in bytes
+        """
+        self.slot_bytes = slot_bytes
+        self.blocks = [shared_memory.SharedMemory(create=True, size=slot_bytes) for _ in range(slots)]
+        self.names = [block.name for block in self.blocks]
+
+    def close(self):
+        """Release and unlink every buffer in the pool"""
+        for block in self.blocks:
+            block.close()
+            block.unlink()
+        self.blocks = []
+
+
+class _ResultPipe:
+    """
+    Channel carrying results from the workers to the parent
+
+    Unlike mp.Queue, whose put() hands the item to a feeder thread, put() here writes
+    straight into the pipe, so a result outlives a worker that exits right after
+    sending it. get() waits at most timeout seconds.
+    """
+
+    def __init__(self):
+        self._reader, self._writer = mp.Pipe(duplex=False)
+        self._lock = mp.Lock()
+
+    def put(self, item):
+        with self._lock:
+            self._writer.send(item)
+
+    def get(self, timeout):
+        if not self._reader.poll(timeout):
+            raise queue.Empty
+        return self._reader.recv()
+
+
+def _attach(names):
+    """Attach to the pool's buffers from inside a worker process"""
+    return [shared_memory.SharedMemory(name=name) for name in names]
+
+
+def _detach(blocks):
+    for block in blocks:
+        block.close()
+
+
+def _hold(holding, w, job=-1, slot=None):
+    """
+    Publish the job and frame slot worker w is holding, so the parent can reclaim them if it dies
+
+    A slot is released here before it is handed on, and a job only once its next stage has it,
+    so a crash can leak a slot or fail a job that completes anyway, but never hands out a slot twice.
+    """
+    holding[2 * w] = job
+    holding[2 * w + 1] = -1 if slot is None else slot
+
+
+def _frame_to_buffer(img, blocks, slot, slot_bytes):
+    """
+    Copy an image into a pool slot
+
+    Returns:
+        dict: Frame descriptor; carries the pixels inline when the frame
+        does not fit in a slot
+    """
+    if img.mode not in SHAREABLE_MODES:
+        img = img.convert('RGBA' if 'A' in img.getbands() or 'transparency' in img.info else 'RGB')
+    arr = np.asarray(img)
+    frame = {
+        'mode': img.mode,
+        'size': img.size,
+        'shape': arr.shape,
+        'dtype': arr.dtype.str,
+        'palette': img.getpalette() if img.mode == 'P' else None,
+        # Only info the later stages read; transparency also decides alpha on conversion
+        'info': {key: img.info[key] for key in FRAME_INFO_KEYS if key in img.info},
+        'slot': None,
+        'array': None,
+    }
+    if slot is not None and arr.nbytes <= slot_bytes:
+        view = np.ndarray(arr.shape, dtype=arr.dtype, buffer=blocks[slot].buf)
+        np.copyto(view, arr)
+        frame['slot'] = slot
+    else:
+        frame['array'] = np.ascontiguousarray(arr)
+    return frame
+
+
+def _frame_from_buffer(frame, blocks):
+    """Build a PIL image over a frame descriptor's pixels (zero-copy where Pillow allows)"""
+    if frame['slot'] is not None:
+        arr = np.ndarray(frame['shape'], dtype=np.dtype(frame['dtype']), buffer=blocks[frame['slot']].buf)
+    else:
+        arr = frame['array']
+    img = Image.frombuffer(frame['mode'], frame['size'], arr, 'raw', frame['mode'], 0, 1)
+    if frame['palette'] is not None:
+        img.putpalette(frame['palette'])
+    img.info.update(frame['info'])
+    return img
+
+
+def _watermark_in_slot(bot, frame, blocks, slot_bytes, frame_kwargs):
+    """Run the pixel stages on a frame and write the result back over its own slot"""
+    img = bot.watermark_frame(_frame_from_buffer(frame, blocks), **frame_kwargs)
+    return _frame_to_buffer(img, blocks, frame['slot'], slot_bytes)
+
+
+def _read_bytes(path):
+    with open(path, 'rb') as f:
+        return f.read()
+
+
+def _decode_worker(names, slot_bytes, bot, cache, output_kwargs, motion_options, retries, task_q, free_q, work_q,
+                   result_q, holding, w):
+    blocks = _attach(names)
+    try:
+        while True:
+            _hold(holding, w)
+            task = task_q.get()
+            if task is None:
+                break
+            job, input_path, output_path = task
+            _hold(holding, w, job)
+            result = ImageResult(input_path, output_path)
+            try:
+                with result.timed('read'):
+                    data = retry_call(lambda: _read_bytes(input_path), result, retries)
+                # Animations are marked here in one go, frames in parallel on their own thread pool
+                prepared = bot.start_job(result, data, cache=cache, motion_options=motion_options,
+                                         retries=retries, **output_kwargs)
+                if prepared is None:
+                    result_q.put((job, result))
+                    continue
+                timestamp, cache_key = prepared
+            except Exception as e:
+                result_q.put((job, result.fail(e)))
+                continue
+            slot = free_q.get()
+            _hold(holding, w, job, slot)
+            try:
+                with result.timed('decode'):
+                    img = bot.load_image(input_path, data)
+                    frame = _frame_to_buffer(img, blocks, slot, slot_bytes)
+            except Exception as e:
+                _hold(holding, w, job)
+                free_q.put(slot)
+                result_q.put((job, result.fail(e)))
+                continue
+            _hold(holding, w, job)
+            if frame['slot'] is None:
+                free_q.put(slot)
+            work_q.put((job, result, frame, timestamp, cache_key))
+    finally:
+        _detach(blocks)
+
+
+def _process_worker(names, slot_bytes, bot, frame_kwargs, work_q, free_q, encode_q, result_q, holding, w):
+    blocks = _attach(names)
+    try:
+        while True:
+            _hold(holding, w)
+            item = work_q.get()
+            if item is None:
+                break
+            job, result, frame, timestamp, cache_key = item
+            slot = frame['slot']
+            _hold(holding, w, job, slot)
+            try:
+                with result.timed('process'):
+                    frame = _watermark_in_slot(bot, frame, blocks, slot_bytes, frame_kwargs)
+            except Exception as e:
+                _hold(holding, w, job)
+                if slot is not None:
+                    free_q.put(slot)
+                result_q.put((job, result.fail(e)))
+                continue
+            _hold(holding, w, job)
+            if slot is not None and frame['slot'] is None:
+                # The result outgrew its slot and travels inline instead
+                free_q.put(slot)
+            encode_q.put((job, result, frame, timestamp, cache_key))
+    finally:
+        _detach(blocks)
+
+
+def _encode_worker(names, bot, cache, add_metadata, renditions, retries, encode_q, free_q, result_q, holding, w):
+    blocks = _attach(names)
+    try:
+        while True:
+            _hold(holding, w)
+            item = encode_q.get()
+            if item is None:
+                break
+            job, result, frame, timestamp, cache_key = item
+            _hold(holding, w, job, frame['slot'])
+            try:
+                bot.finish_job(result, _frame_from_buffer(frame, blocks), timestamp, cache=cache,
+                               cache_key=cache_key, add_metadata=add_metadata, renditions=renditions,
+                               retries=retries)
+            except Exception as e:
+                result.fail(e)
+            _hold(holding, w, job)
+            if frame['slot'] is not None:
+                free_q.put(frame['slot'])
+            result_q.put((job, result))
+    finally:
+        _detach(blocks)
+
+
+def run_pipeline(bot, jobs, add_invisible=True, add_visible=True, add_metadata=True,
+                 visible_text="© 2024", visible_positions=None, font_size=24, opacity=70,
+                 renditions=None, invisible_text="Protected", decode_workers=1, process_workers=None, encode_workers=None,
+                 slots=None, slot_mb=128, cache=None, retries=2, motion_options=None):
+    """
+    Watermark many images with overlapping decode, process and encode stages
+
+    Args:
+        bot (WatermarkBot): Configured bot (pickled once per worker)
+        jobs (list): (input_path, output_path) pairs
+        add_invisible, add_visible, add_metadata, visible_text, visible_positions,
+        font_size, opacity, renditions, invisible_text: Same as WatermarkBot.process_image
+        decode_workers (int): Processes decoding input files
+        process_workers (int): Processes applying the watermark stages (default: CPU count)
+        encode_workers (int): Processes compressing PNG output (default: half the CPU count)
+        slots (int): Shared-memory buffers in the pool (default: one per worker plus two)
+        slot_mb (int): Size of each buffer in MiB; larger frames fall back to pickling
+        cache (OutputCache): Serve repeated requests from, and store results in, this cache
+        retries (int): Times to retry reading an input or writing an output on transient I/O errors
+        motion_options (dict): Extra arguments for animated inputs (see WatermarkBot.process_image)
+
+    Yields:
+        ImageResult: One per job, in completion order
+    """
+    cpus = mp.cpu_count()
+    if process_workers is None:
+        process_workers = cpus
+    if encode_workers is None:
+        encode_workers = max(1, cpus // 2)
+    if slots is None:
+        slots = decode_workers + process_workers + encode_workers + 2
+    slot_bytes = slot_mb * 1024 * 1024
+
+    frame_kwargs = {
+        'add_invisible': add_invisible,
+        'add_visible': add_visible,
+        'visible_text': visible_text,
+        'visible_positions': visible_positions,
+        'font_size': font_size,
+        'opacity': opacity,
+        'invisible_text': invisible_text,
+    }
+    output_kwargs = dict(frame_kwargs, add_metadata=add_metadata, renditions=renditions)
+
+    pool = SharedFramePool(slots, slot_bytes)
+    # Workers hand frames, slots and results on through channels that write synchronously,
+    # so nothing a worker has passed on is lost if it dies straight afterwards
+    task_q = mp.Queue()
+    work_q, encode_q, free_q = mp.SimpleQueue(), mp.SimpleQueue(), mp.SimpleQueue()
+    result_q = _ResultPipe()
+    for slot in range(slots):
+        free_q.put(slot)
+
+    stages = [
+        (decode_workers, task_q, _decode_worker,
+         (pool.names, slot_bytes, bot, cache, output_kwargs, motion_options, retries, task_q, free_q, work_q,
+          result_q)),
+        (process_workers, work_q, _process_worker,
+         (pool.names, slot_bytes, bot, frame_kwargs, work_q, free_q, encode_q, result_q)),
+        (encode_workers, encode_q, _encode_worker,
+         (pool.names, bot, cache, add_metadata, renditions, retries, encode_q, free_q, result_q)),
+    ]
+    # Per worker: the job index and frame slot it currently holds (-1 for none)
+    holding = mp.RawArray('q', [-1] * (2 * sum(count for count, _, _, _ in stages)))
+    workers = []
+    for count, _, target, args in stages:
+        for _ in range(count):
+            workers.append((target, args + (holding, len(workers))))
+    processes = [_start_worker(target, args) for target, args in workers]
+
+    pending = dict(enumerate(jobs))
+    try:
+        for job, (input_path, output_path) in pending.items():
+            task_q.put((job, input_path, output_path))
+        # Every job produces exactly one result, whichever stage it ends in
+        while pending:
+            try:
+                job, result = result_q.get(timeout=1)
+            except queue.Empty:
+                # Quiet for a while: check for workers that died holding a job
+                for w, process in enumerate(processes):
+                    if process.exitcode is None:
+                        continue
+                    job, slot = holding[2 * w], holding[2 * w + 1]
+                    _hold(holding, w)
+                    if slot >= 0:
+                        free_q.put(slot)
+                    if job in pending:
+                        yield ImageResult(*pending.pop(job)).fail(
+                            RuntimeError(f"Pipeline worker exited with code {process.exitcode}"))
+                    processes[w] = _start_worker(*workers[w])
+                continue
+            # A job failed after its worker died may still complete; it is reported once
+            if pending.pop(job, None) is not None:
+                yield result
+    finally:
+        for count, queue_, _, _ in stages:
+            for _ in range(count):
+                queue_.put(None)
+        for process in processes:
+            process.join(timeout=5)
+            if process.is_alive():
+                process.terminate()
+        pool.close()
+
+
+def _start_worker(target, args):
+    process = mp.Process(target=target, args=args, daemon=True)
+    process.start()
+    return process
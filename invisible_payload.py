@@ -0,0 +1,319 @@
+#!/usr/bin/env python3
+"""
+Framed payload format for the invisible (LSB) watermark.
+
+The text is stored as UTF-8 behind a small header (magic, version, error
+correction level, length) and followed by a CRC32, optionally protected by
+Reed-Solomon parity. With a key, the whole frame is then XORed with a
+SHAKE-256 keystream derived from it, so without the key the text can neither
+be read nor told apart from noise. The frame is repeated in every tile of the
+image, with each tile's samples assigned to frame bits by a keyed
+pseudo-random permutation, so the mark is spread across the whole image,
+majority-voted on extraction and still found after a crop.
+"""
+
+import hashlib
+import struct
+import zlib
+
+import numpy as np
+
+try:
+    import reedsolo
+except ImportError:  # Optional, only needed for error correction
+    reedsolo = None
+
+# Modes the invisible watermark embeds into natively, with carrier samples per pixel
+INVISIBLE_MODES = {'L': 1, 'LA': 1, 'I': 1, 'I;16': 1, 'RGB': 3, 'RGBA': 3, 'CMYK': 4}
+
+MAGIC = b'WM'
+VERSION = 3
+TILE = 64
+HEADER_BITS = 64
+HEADER_REPEAT = 4
+HEADER_SLOTS = HEADER_BITS * HEADER_REPEAT
+CRC_BYTES = 4
+
+
+def carrier_view(img):
+    """
+    Expose the samples that carry the watermark, in the image's native layout
+
+    Args:
+        img (PIL.Image.Image): Image in one of INVISIBLE_MODES, or a palette image
+
+    Returns:
+        tuple: (buffer, carrier) where buffer is a private copy of the pixel (or palette)
+        data (in its own raw mode, for palettes) and carrier is a writable
+        (height, width, channels) view into it
+    """
+    if img.mode == 'P':
+        # Palette indices can't take LSB changes without shifting colours, the palette entries can
+        rawmode = img.palette.mode
+        buffer = np.array(img.getpalette(rawmode), dtype=np.uint8)
+        return buffer, buffer.reshape(1, -1, len(rawmode))[..., :3]
+    if img.mode not in INVISIBLE_MODES:
+        raise ValueError(f"Unsupported image mode for invisible watermark: {img.mode}")
+    buffer = np.array(img)
+    if buffer.ndim == 2:  # L, I, I;16
+        return buffer, buffer[..., np.newaxis]
+    # Colour samples only, alpha is left alone
+    return buffer, buffer[..., :INVISIBLE_MODES[img.mode]]
+
+
+def carrier_shape(img):
+    """(height, width, channels) of an image's carrier view, without copying any pixels"""
+    if img.mode == 'P':
+        return 1, len(img.getpalette()) // 3, 3
+    return img.height, img.width, INVISIBLE_MODES[img.mode]
+
+
+def tile_shape(shape, mode):
+    """Tile the frame is repeated in; palettes are a single tile"""
+    height, width, channels = shape
+    if mode == 'P':
+        return height, width, channels
+    return min(TILE, height), min(TILE, width), channels
+
+
+def capacity(shape, mode, ecc_symbols=0):
+    """
+    Largest UTF-8 payload, in bytes, that fits in every tile
+
+    Args:
+        shape (tuple): Carrier shape from carrier_shape
+        mode (str): Image mode
+        ecc_symbols (int): Reed-Solomon parity bytes per 255-byte block
+
+    Returns:
+        int: Capacity in bytes (0 if the image can't hold a frame)
+    """
+    th, tw, channels = tile_shape(shape, mode)
+    body_bytes = (th * tw * channels - HEADER_SLOTS) // 8
+    if ecc_symbols:
+        # Each block of up to 255 bytes carries ecc_symbols bytes of parity
+        full_blocks, rest = divmod(body_bytes, 255)
+        body_bytes = full_blocks * (255 - ecc_symbols) + max(0, rest - ecc_symbols)
+    return max(0, body_bytes - CRC_BYTES)
+
+
+def _slot_ranks(key, shape):
+    """Keyed pseudo-random rank of every slot in a tile"""
+    digest = hashlib.sha256(f"{key or ''}|{shape[0]}x{shape[1]}x{shape[2]}".encode('utf-8')).digest()
+    rng = np.random.default_rng(int.from_bytes(digest[:8], 'big'))
+    return rng.permutation(shape[0] * shape[1] * shape[2]).reshape(shape)
+
+
+def _keystream(key, length):
+    """Bytes a keyed frame is XORed with, header first and then body (None without a key)"""
+    if not key:
+        return None
+    return np.frombuffer(hashlib.shake_256(f"payload|{key}".encode('utf-8')).digest(length), dtype=np.uint8)
+
+
+def _xor(data, stream):
+    return (np.frombuffer(data, dtype=np.uint8) ^ stream).tobytes()
+
+
+def _header(ecc_symbols, body_length):
+    head = MAGIC + struct.pack('>BBH', VERSION, ecc_symbols, body_length)
+    return head + struct.pack('>H', zlib.crc32(head) & 0xFFFF)
+
+
+def _parse_header(header):
+    """Return (ecc_symbols, body_length) or None if header isn't a valid frame header"""
+    head, check = header[:6], header[6:]
+    if head[:2] != MAGIC or struct.unpack('>H', check)[0] != zlib.crc32(head) & 0xFFFF:
+        return None
+    version, ecc_symbols, body_length = struct.unpack('>BBH', head[2:])
+    if version != VERSION:
+        return None
+    return ecc_symbols, body_length
+
+
+def encode_frame(text, ecc_symbols=0, key=None):
+    """
+    Build the header and body bytes for a payload
+
+    Returns:
+        tuple: (header bytes, body bytes), encrypted when a key is given
+    """
+    payload = text.encode('utf-8')
+    body = payload + struct.pack('>I', zlib.crc32(payload))
+    if ecc_symbols:
+        if reedsolo is None:
+            raise ValueError("Error correction requires the 'reedsolo' package")
+        body = bytes(reedsolo.RSCodec(ecc_symbols).encode(body))
+    if len(body) > 0xFFFF:
+        raise ValueError("Invisible watermark text is too long")
+    header = _header(ecc_symbols, len(body))
+    stream = _keystream(key, len(header) + len(body))
+    if stream is not None:
+        # After the parity is added, so flipped bits stay where error correction can find them
+        header, body = _xor(header, stream[:len(header)]), _xor(body, stream[len(header):])
+    return header, body
+
+
+def decode_body(body, ecc_symbols):
+    """Return the payload text, or None if the body fails error correction or its CRC"""
+    if ecc_symbols:
+        if reedsolo is None:
+            return None
+        try:
+            body = bytes(reedsolo.RSCodec(ecc_symbols).decode(body)[0])
+        except reedsolo.ReedSolomonError:
+            return None
+    payload, crc = body[:-CRC_BYTES], body[-CRC_BYTES:]
+    if len(crc) != CRC_BYTES or struct.unpack('>I', crc)[0] != zlib.crc32(payload):
+        return None
+    try:
+        return payload.decode('utf-8')
+    except UnicodeDecodeError:
+        return None
+
+
+def embed(carrier, mode, text, key=None, ecc_symbols=0):
+    """
+    Write a payload into the LSBs of a carrier view, in place
+
+    Args:
+        carrier (numpy.ndarray): Carrier view from carrier_view
+        mode (str): Image mode
+        text (str): Payload text
+        key (str): Secret that decides which samples carry which bits and encrypts them
+        ecc_symbols (int): Reed-Solomon parity bytes per 255-byte block (0 disables)
+    """
+    header, body = encode_frame(text, ecc_symbols, key)
+    shape = tile_shape(carrier.shape, mode)
+    slots = shape[0] * shape[1] * shape[2]
+    if HEADER_SLOTS + len(body) * 8 > slots:
+        raise ValueError(f"Image too small to hold watermark text "
+                         f"({len(text.encode('utf-8'))} bytes, capacity {capacity(carrier.shape, mode, ecc_symbols)})")
+
+    # Bit value for every rank: header bits first, then the body repeated over the rest
+    header_bits = np.unpackbits(np.frombuffer(header, dtype=np.uint8))
+    body_bits = np.unpackbits(np.frombuffer(body, dtype=np.uint8))
+    ranks = np.arange(slots)
+    values = np.empty(slots, dtype=np.uint8)
+    values[:HEADER_SLOTS] = header_bits[ranks[:HEADER_SLOTS] % HEADER_BITS]
+    values[HEADER_SLOTS:] = body_bits[(ranks[HEADER_SLOTS:] - HEADER_SLOTS) % len(body_bits)]
+    tile = values[_slot_ranks(key, shape)].astype(carrier.dtype)
+
+    # One row of tiles, reused for every band of the image
+    th, tw = shape[:2]
+    height, width = carrier.shape[:2]
+    row = np.tile(tile, (1, -(-width // tw), 1))[:, :width]
+    target, row, keep = _contiguous_target(carrier, row)
+    for y in range(0, height, th):
+        band = target[y:y + th]
+        np.bitwise_and(band, keep, out=band)
+        band |= row[:band.shape[0]]
+
+
+def _contiguous_target(carrier, row):
+    """
+    Array the LSB passes run over, with its bit row and the mask of bits to keep
+
+    A carrier that is the leading channels of a contiguous pixel buffer (the colour
+    samples of RGBA, or of the frames in animated_watermark) would be written
+    through a strided view. Instead the whole buffer is viewed as one integer per
+    pixel and masked so the other channels' bits are kept, which runs over
+    contiguous memory.
+
+    Returns:
+        tuple: (target array, row of bits matching it, keep mask)
+    """
+    clear_lsb = ~carrier.dtype.type(1)
+    base = carrier.base
+    if (carrier.flags.c_contiguous or not isinstance(base, np.ndarray) or not base.flags.c_contiguous
+            or base.ndim != 3 or base.shape[:2] != carrier.shape[:2]
+            or base.ctypes.data != carrier.ctypes.data or base.strides[1] not in (2, 4, 8)):
+        return carrier, row, clear_lsb
+    pixel = np.dtype(f'u{base.strides[1]}')
+    keep = np.full(base.shape[2], ~base.dtype.type(0))
+    keep[:carrier.shape[2]] = clear_lsb
+    wide = np.zeros(row.shape[:2] + base.shape[2:], dtype=base.dtype)
+    wide[..., :carrier.shape[2]] = row
+    return base.view(pixel)[..., 0], wide.view(pixel)[..., 0], keep.view(pixel)[0]
+
+
+def _fold_lsbs(carrier, shape):
+    """Sum the LSBs of all tiles onto one tile, with the number of samples per slot"""
+    th, tw, channels = shape
+    height, width = carrier.shape[:2]
+    lsbs = (carrier & 1).astype(np.uint8)
+    pad_h, pad_w = -height % th, -width % tw
+    if pad_h or pad_w:
+        lsbs = np.pad(lsbs, ((0, pad_h), (0, pad_w), (0, 0)))
+    ones = lsbs.reshape(lsbs.shape[0] // th, th, lsbs.shape[1] // tw, tw, channels).sum(axis=(0, 2), dtype=np.int64)
+    rows = height // th + (np.arange(th) < height % th)
+    cols = width // tw + (np.arange(tw) < width % tw)
+    return ones, np.outer(rows, cols)
+
+
+def extract(carrier, mode, key=None, search_offsets=True):
+    """
+    Read a payload back from a carrier view
+
+    Args:
+        carrier (numpy.ndarray): Carrier view from carrier_view
+        mode (str): Image mode
+        key (str): Secret used when embedding
+        search_offsets (bool): Also try every tile alignment, to read marks from cropped images
+
+    Returns:
+        str: Payload text, or None if no valid payload is found
+    """
+    shape = tile_shape(carrier.shape, mode)
+    th, tw, channels = shape
+    if th * tw * channels < HEADER_SLOTS:
+        return None
+    ranks = _slot_ranks(key, shape)
+    ones, counts = _fold_lsbs(carrier, shape)
+
+    # Header slot coordinates grouped by header bit: (HEADER_BITS, HEADER_REPEAT)
+    order = np.argsort(ranks, axis=None)[:HEADER_SLOTS]
+    ys, xs, cs = np.unravel_index(order, shape)
+    by_bit = np.argsort(np.arange(HEADER_SLOTS) % HEADER_BITS, kind='stable').reshape(HEADER_BITS, HEADER_REPEAT)
+    ys, xs, cs = ys[by_bit], xs[by_bit], cs[by_bit]
+
+    if search_offsets:
+        offset_y, offset_x = np.divmod(np.arange(th * tw), tw)
+    else:
+        offset_y, offset_x = np.zeros(1, dtype=int), np.zeros(1, dtype=int)
+
+    # Majority-vote the header at every candidate alignment at once
+    yy = (ys[np.newaxis] - offset_y[:, np.newaxis, np.newaxis]) % th
+    xx = (xs[np.newaxis] - offset_x[:, np.newaxis, np.newaxis]) % tw
+    votes = ones[yy, xx, cs[np.newaxis]].sum(axis=-1)
+    totals = counts[yy, xx].sum(axis=-1)
+    headers = np.packbits((2 * votes > totals).astype(np.uint8), axis=-1)
+    header_stream = _keystream(key, HEADER_BITS // 8)
+    if header_stream is not None:
+        headers ^= header_stream
+    magic = np.frombuffer(MAGIC, dtype=np.uint8)
+    candidates = np.flatnonzero((headers[:, :2] == magic).all(axis=1))
+
+    body_ranks = ranks - HEADER_SLOTS
+    body_mask = body_ranks >= 0
+    for candidate in candidates:
+        parsed = _parse_header(headers[candidate].tobytes())
+        if parsed is None:
+            continue
+        ecc_symbols, body_length = parsed
+        body_bits = body_length * 8
+        if body_bits == 0 or HEADER_SLOTS + body_bits > ranks.size:
+            continue
+        shift = (offset_y[candidate], offset_x[candidate])
+        aligned_ones = np.roll(ones, shift, axis=(0, 1))
+        aligned_counts = np.broadcast_to(np.roll(counts, shift, axis=(0, 1))[..., np.newaxis], shape)
+        bit_index = body_ranks[body_mask] % body_bits
+        bit_votes = np.bincount(bit_index, weights=aligned_ones[body_mask], minlength=body_bits)
+        bit_totals = np.bincount(bit_index, weights=aligned_counts[body_mask], minlength=body_bits)
+        body = np.packbits((2 * bit_votes > bit_totals).astype(np.uint8)).tobytes()
+        if header_stream is not None:
+            body = _xor(body, _keystream(key, HEADER_BITS // 8 + body_length)[HEADER_BITS // 8:])
+        text = decode_body(body, ecc_symbols)
+        if text is not None:
+            return text
+    return None
@@ -0,0 +1,142 @@
+#!/usr/bin/env python3
+"""
+Content-addressed on-disk cache of watermarked outputs.
+Entries are keyed on a hash of the input bytes and a hash of the settings
+that produced them, and the least recently used entries are evicted once the
+cache grows past its size limit.
+"""
+
+import errno
+import hashlib
+import json
+import os
+import shutil
+import tempfile
+
+# Eviction trims the cache to this fraction of its limit, so the directory is only
+# rescanned once that much more has been stored
+EVICT_TARGET = 0.9
+
+
+class OutputCache:
+    def __init__(self, cache_dir, max_bytes=1024 * 1024 * 1024):
+        """
+        Open (or create) an output cache directory
+
+        Args:
+            cache_dir (str): Directory holding the cache entries
+            max_bytes (int): Total size above which least recently used entries are evicted
+        """
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        # Running total of the entries' sizes: set by each scan of the directory, then
+        # increased by this instance's stores (other workers' are seen at the next scan)
+        self._total = None
+        os.makedirs(cache_dir, exist_ok=True)
+
+    def key(self, data, settings):
+        """
+        Cache key for an input and the settings applied to it
+
+        Args:
+            data (bytes): Raw input file contents
+            settings (dict): JSON-serialisable settings that affect the output
+
+        Returns:
+            str: Hex digest naming the cache entry
+        """
+        input_hash = hashlib.sha256(data).hexdigest()
+        settings_hash = hashlib.sha256(json.dumps(settings, sort_keys=True, default=str).encode('utf-8')).hexdigest()
+        return hashlib.sha256(f"{input_hash}:{settings_hash}".encode('ascii')).hexdigest()
+
+    def _entry_dir(self, key):
+        return os.path.join(self.cache_dir, key)
+
+    def fetch(self, key, files):
+        """
+        Copy a cached entry's files out of the cache
+
+        Args:
+            key (str): Cache key
+            files (dict): Maps each cached file name to its destination path
+
+        Returns:
+            bool: True on a hit, False if the entry is missing or incomplete
+        """
+        entry = self._entry_dir(key)
+        sources = {name: os.path.join(entry, name) for name in files}
+        if not all(os.path.isfile(path) for path in sources.values()):
+            return False
+        copied = []
+        try:
+            for name, dest in files.items():
+                copied.append(dest)
+                shutil.copyfile(sources[name], dest)
+        except FileNotFoundError:
+            # Evicted by another worker since the check: drop what was copied and miss
+            for dest in copied:
+                try:
+                    os.remove(dest)
+                except FileNotFoundError:
+                    pass
+            return False
+        # The entry's mtime records its last use for LRU eviction
+        try:
+            os.utime(entry)
+        except FileNotFoundError:
+            pass
+        return True
+
+    def store(self, key, files):
+        """
+        Add files to the cache under key, evicting old entries once it outgrows the size limit
+
+        Args:
+            key (str): Cache key
+            files (dict): Maps each cached file name to the path to copy it from
+        """
+        entry = self._entry_dir(key)
+        if os.path.isdir(entry):
+            os.utime(entry)
+            return
+        # Build the entry beside its final location and rename it into place, so
+        # concurrent readers never see a partial entry
+        staging = tempfile.mkdtemp(prefix='.staging-', dir=self.cache_dir)
+        size = 0
+        try:
+            for name, source in files.items():
+                shutil.copyfile(source, os.path.join(staging, name))
+                size += os.path.getsize(os.path.join(staging, name))
+            os.rename(staging, entry)
+        except OSError as e:
+            shutil.rmtree(staging, ignore_errors=True)
+            if e.errno in (errno.EEXIST, errno.ENOTEMPTY) and os.path.isdir(entry):
+                return  # Another worker stored the same entry first
+            raise
+        if self._total is None or self._total + size > self.max_bytes:
+            self.evict()
+        else:
+            self._total += size
+
+    def evict(self):
+        """Scan the cache and remove least recently used entries once it is over max_bytes"""
+        entries = []
+        total = 0
+        for name in os.listdir(self.cache_dir):
+            if name.startswith('.staging-'):
+                continue
+            entry = os.path.join(self.cache_dir, name)
+            try:
+                size = sum(os.path.getsize(os.path.join(entry, f)) for f in os.listdir(entry))
+                entries.append((os.path.getmtime(entry), size, entry))
+            except OSError:
+                continue  # Evicted by another worker meanwhile
+            total += size
+        if total > self.max_bytes:
+            entries.sort()
+            for _, size, entry in entries:
+                if total <= self.max_bytes * EVICT_TARGET:
+                    break
+                shutil.rmtree(entry, ignore_errors=True)
+                total -= size
+        self._total = total
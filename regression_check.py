@@ -0,0 +1,321 @@
+#!/usr/bin/env python3
+"""
+Memory and throughput regression check for batch watermarking.
+Generates synthetic corpora (many small images, a few very large ones), runs
+each batch mode in a fresh worker process and checks peak RSS, per-image
+latency and stray files against fixed ceilings and a stored baseline. Also
+checks that every compositing backend renders the visible watermark
+pixel-identically. Runs offline on Linux; exits non-zero when a check fails.
+"""
+
+import argparse
+import contextlib
+import json
+import os
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+
+import numpy as np
+from PIL import Image
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+DEFAULT_BASELINE = os.path.join(HERE, 'perf_baseline.json')
+
+# Batch modes measured for each corpus
+MODES = ('sequential', 'pipeline')
+
+
+def generate_corpus(directory, count, width, height, seed):
+    """Write count synthetic images (alternating JPEG and PNG) into directory"""
+    os.makedirs(directory, exist_ok=True)
+    rng = np.random.default_rng(seed)
+    y = np.arange(height, dtype=np.int16)[:, np.newaxis]
+    x = np.arange(width, dtype=np.int32)[np.newaxis, :]
+    # Smooth gradients compress like photographs; a little noise keeps encoders honest
+    base = np.empty((height, width, 3), dtype=np.int16)
+    base[..., 0] = x * 255 // max(1, width - 1)
+    base[..., 1] = y.astype(np.int32) * 255 // max(1, height - 1)
+    base[..., 2] = ((x + y) // 4) % 256
+    for i in range(count):
+        noise = rng.integers(-3, 4, size=base.shape, dtype=np.int16)
+        img = Image.fromarray(np.clip(base + noise + i, 0, 255).astype(np.uint8))
+        if i % 2:
+            img.save(os.path.join(directory, f"img_{i:05d}.png"))
+        else:
+            img.save(os.path.join(directory, f"img_{i:05d}.jpg"), quality=90)
+
+
+def peak_rss_kib():
+    """
+    Peak RSS of this process in KiB
+
+    VmHWM is used rather than ru_maxrss, which Linux carries over from the parent across exec
+    """
+    with open('/proc/self/status', encoding='ascii') as f:
+        for line in f:
+            if line.startswith('VmHWM:'):
+                return int(line.split()[1])
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+
+def image_latencies(report_path):
+    """Per-image processing time in ms (the sum of its stage timings) from a JSONL report"""
+    with open(report_path, encoding='utf-8') as f:
+        return [sum(json.loads(line)['timings_ms'].values()) for line in f if line.strip()]
+
+
+def run_worker(input_dir, output_dir, report_path, mode):
+    """Process a corpus in this process and return its measurements"""
+    sys.path.insert(0, HERE)
+    from batch_processor import BatchWatermarkProcessor
+
+    processor = BatchWatermarkProcessor(author_name="Regression", website="example.com",
+                                        timestamp='input')
+    count = len(processor.get_image_files(input_dir))
+    start = time.perf_counter()
+    with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+        if mode == 'pipeline':
+            processor.process_directory_pipelined(input_dir, output_dir, "_wm", process_workers=2,
+                                                  encode_workers=1, report_path=report_path)
+        else:
+            processor.process_directory(input_dir, output_dir, "_wm", report_path=report_path)
+    elapsed = time.perf_counter() - start
+    # The mean hides single slow images (e.g. one frame hitting a slow path), so the tail is checked too
+    latencies = image_latencies(report_path) or [0.0]
+
+    # RUSAGE_CHILDREN reports the largest pipeline worker (ru_maxrss is in KiB on Linux)
+    peak_kib = max(peak_rss_kib(), resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss)
+    return {
+        'images': count,
+        'outputs': len(os.listdir(output_dir)),
+        'ms_per_image': 1000.0 * elapsed / max(1, count),
+        'p95_ms': float(np.percentile(latencies, 95)),
+        'max_ms': max(latencies),
+        'peak_rss_mb': peak_kib / 1024.0,
+    }
+
+
+def measure(input_dir, work_dir, mode):
+    """Run one batch mode in a fresh interpreter with an empty working directory"""
+    cwd = tempfile.mkdtemp(dir=work_dir)
+    output_dir = tempfile.mkdtemp(dir=work_dir)
+    report_fd, report_path = tempfile.mkstemp(suffix='.jsonl', dir=work_dir)
+    os.close(report_fd)
+    result = subprocess.run(
+        [sys.executable, os.path.abspath(__file__), '--worker', mode, input_dir, output_dir, report_path],
+        cwd=cwd, capture_output=True, text=True, check=True)
+    stats = json.loads(result.stdout.strip().splitlines()[-1])
+    stats['stray_files'] = sorted(os.listdir(cwd))
+    return stats
+
+
+def check(name, stats, baseline, args):
+    """Return a list of failure messages for one scenario"""
+    failures = []
+    if stats['stray_files']:
+        failures.append(f"{name}: files leaked into the working directory: {stats['stray_files'][:5]}")
+    if stats['outputs'] != stats['images']:
+        failures.append(f"{name}: {stats['images']} inputs but {stats['outputs']} outputs")
+    if args.max_rss_mb and stats['peak_rss_mb'] > args.max_rss_mb:
+        failures.append(f"{name}: peak RSS {stats['peak_rss_mb']:.0f} MB exceeds ceiling {args.max_rss_mb} MB")
+    ceiling = args.max_large_ms if name.startswith('large') else args.max_small_ms
+    if ceiling and stats['ms_per_image'] > ceiling:
+        failures.append(f"{name}: {stats['ms_per_image']:.1f} ms/image exceeds ceiling {ceiling} ms")
+    ceiling = args.max_large_p95_ms if name.startswith('large') else args.max_small_p95_ms
+    if ceiling and stats['p95_ms'] > ceiling:
+        failures.append(f"{name}: p95 of {stats['p95_ms']:.1f} ms per image exceeds ceiling {ceiling} ms "
+                        f"(slowest image {stats['max_ms']:.1f} ms)")
+    if baseline:
+        if stats['peak_rss_mb'] > baseline['peak_rss_mb'] * (1 + args.rss_tolerance):
+            failures.append(f"{name}: peak RSS {stats['peak_rss_mb']:.0f} MB vs baseline "
+                            f"{baseline['peak_rss_mb']:.0f} MB (+{args.rss_tolerance:.0%} allowed)")
+        if stats['ms_per_image'] > baseline['ms_per_image'] * (1 + args.time_tolerance):
+            failures.append(f"{name}: {stats['ms_per_image']:.1f} ms/image vs baseline "
+                            f"{baseline['ms_per_image']:.1f} ms (+{args.time_tolerance:.0%} allowed)")
+        # Baselines recorded before tail latencies were measured don't have p95_ms
+        if 'p95_ms' in baseline and stats['p95_ms'] > baseline['p95_ms'] * (1 + args.time_tolerance):
+            failures.append(f"{name}: p95 of {stats['p95_ms']:.1f} ms per image vs baseline "
+                            f"{baseline['p95_ms']:.1f} ms (+{args.time_tolerance:.0%} allowed)")
+    return failures
+
+
+def check_backend_parity(seed=0):
+    """
+    Render the visible watermark with every compositing backend and compare the pixels
+
+    Covers every image mode the batch accepts, images smaller than the text, overlapping
+    positions and the full opacity range.
+
+    Returns:
+        list: Failure messages
+    """
+    sys.path.insert(0, HERE)
+    from composite import BACKENDS
+    from watermark_bot import WatermarkBot
+
+    bots = [WatermarkBot(composite_backend=backend) for backend in BACKENDS]
+    rng = np.random.default_rng(seed)
+    all_positions = ['top-left', 'top-right', 'bottom-left', 'bottom-right', 'center']
+    failures = []
+    for mode in ('RGB', 'RGBA', 'L', 'LA', 'P', 'CMYK', 'I;16'):
+        for width, height in ((640, 480), (120, 40), (30, 20)):
+            img = Image.fromarray(rng.integers(0, 256, (height, width, 4), dtype=np.uint8), 'RGBA')
+            if mode != 'RGBA':
+                img = img.convert(mode)
+            for font_size in (12, 90):
+                for positions in (None, all_positions):
+                    for opacity in (0, 35, 100):
+                        reference, *others = [
+                            np.asarray(bot.render_visible(img, "© 2024 שלום", positions, opacity, font_size))
+                            for bot in bots]
+                        for backend, pixels in zip(BACKENDS[1:], others):
+                            if pixels.shape != reference.shape or (pixels != reference).any():
+                                failures.append(f"backend {backend} differs from {BACKENDS[0]}: mode {mode}, "
+                                                f"{width}x{height}, font {font_size}, positions {positions}, "
+                                                f"opacity {opacity}")
+    return failures
+
+
+def check_invisible_roundtrip(seed=0):
+    """
+    Embed the invisible watermark and read it back
+
+    Covers Hebrew text in every image mode, with and without a key, crops at
+    arbitrary offsets, Reed-Solomon correction of flipped bits (when reedsolo is
+    installed), and that a wrong or missing key finds nothing.
+
+    Returns:
+        list: Failure messages
+    """
+    sys.path.insert(0, HERE)
+    import invisible_payload
+    from watermark_bot import WatermarkBot
+
+    text = "© 2024 שלום עולם"
+    keyed, other, unkeyed = (WatermarkBot(watermark_key=key) for key in ("regression", "other", None))
+    rng = np.random.default_rng(seed)
+    failures = []
+    for mode in ('RGB', 'RGBA', 'L', 'LA', 'P', 'CMYK', 'I;16'):
+        img = Image.fromarray(rng.integers(0, 256, (200, 300, 4), dtype=np.uint8), 'RGBA')
+        if mode != 'RGBA':
+            img = img.convert(mode)
+        for bot in (keyed, unkeyed):
+            marked = bot.embed_invisible(img, text)
+            found = bot.extract_invisible(marked, search_offsets=False)
+            if found != text:
+                failures.append(f"invisible round trip: mode {mode}, key {bot.watermark_key}, read {found!r}")
+        for bot in (other, unkeyed):
+            found = bot.extract_invisible(keyed.embed_invisible(img, text))
+            if found is not None:
+                failures.append(f"invisible mark under key 'regression' read with key {bot.watermark_key}: "
+                                f"mode {mode}, read {found!r}")
+
+    img = Image.fromarray(rng.integers(0, 256, (200, 300, 3), dtype=np.uint8), 'RGB')
+    marked = keyed.embed_invisible(img, text)
+    for left, top in ((17, 23), (63, 1), (100, 64)):
+        found = keyed.extract_invisible(marked.crop((left, top, left + 150, top + 100)))
+        if found != text:
+            failures.append(f"invisible round trip after crop at ({left}, {top}): read {found!r}")
+
+    if invisible_payload.reedsolo is None:
+        print("  reedsolo is not installed; skipping the error correction round trip")
+        return failures
+    # One tile filled by a single copy of the body, so no bit is majority-voted back
+    # and only the parity can undo the flips
+    ecc = WatermarkBot(watermark_key="regression", ecc_symbols=16)
+    img = Image.fromarray(rng.integers(0, 256, (64, 64, 3), dtype=np.uint8), 'RGB')
+    long_text = "ש" * (ecc.invisible_capacity(img) // 2)
+    shape = invisible_payload.tile_shape(invisible_payload.carrier_shape(img), 'RGB')
+    ranks = invisible_payload._slot_ranks(ecc.watermark_key, shape)
+    body_slots = np.argwhere(ranks >= invisible_payload.HEADER_SLOTS)
+    pixels = np.array(ecc.embed_invisible(img, long_text))
+    for y, x, c in body_slots[rng.choice(len(body_slots), 6, replace=False)]:
+        pixels[y, x, c] ^= 1
+    found = ecc.extract_invisible(Image.fromarray(pixels, 'RGB'), search_offsets=False)
+    if found != long_text:
+        failures.append(f"invisible mark not recovered by error correction after 6 flipped bits: read {found!r}")
+    return failures
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Memory and throughput regression check for batch watermarking')
+    parser.add_argument('--small-count', type=int, default=2000, help='Number of small images (default: 2000)')
+    parser.add_argument('--small-size', default='64x48', help='Size of small images (default: 64x48)')
+    parser.add_argument('--large-count', type=int, default=3, help='Number of large images (default: 3)')
+    parser.add_argument('--large-size', default='6000x4000', help='Size of large images (default: 6000x4000)')
+    parser.add_argument('--baseline', default=DEFAULT_BASELINE, help='Baseline JSON file (default: perf_baseline.json)')
+    parser.add_argument('--update-baseline', action='store_true', help='Record this run as the new baseline')
+    parser.add_argument('--time-tolerance', type=float, default=0.5, help='Allowed slowdown vs baseline (default: 0.5 = 50%%)')
+    parser.add_argument('--rss-tolerance', type=float, default=0.25, help='Allowed peak RSS growth vs baseline (default: 0.25 = 25%%)')
+    parser.add_argument('--max-rss-mb', type=float, default=2048, help='Hard ceiling on peak RSS per worker in MB (default: 2048)')
+    parser.add_argument('--max-small-ms', type=float, default=50, help='Hard ceiling on ms per small image (default: 50)')
+    parser.add_argument('--max-large-ms', type=float, default=30000, help='Hard ceiling on ms per large image (default: 30000)')
+    parser.add_argument('--max-small-p95-ms', type=float, default=100, help='Hard ceiling on the 95th percentile time of a small image, in ms (default: 100)')
+    parser.add_argument('--max-large-p95-ms', type=float, default=120000, help='Hard ceiling on the 95th percentile time of a large image, in ms (default: 120000)')
+    parser.add_argument('--worker', nargs=4, metavar=('MODE', 'INPUT_DIR', 'OUTPUT_DIR', 'REPORT'), help=argparse.SUPPRESS)
+
+    args = parser.parse_args()
+
+    if args.worker:
+        mode, input_dir, output_dir, report_path = args.worker
+        print(json.dumps(run_worker(input_dir, output_dir, report_path, mode)))
+        return
+
+    corpora = {
+        'small': (args.small_count, args.small_size),
+        'large': (args.large_count, args.large_size),
+    }
+
+    baselines = {}
+    if os.path.exists(args.baseline) and not args.update_baseline:
+        with open(args.baseline, encoding='utf-8') as f:
+            recorded = json.load(f)
+        if recorded.get('corpora') == {k: list(v) for k, v in corpora.items()}:
+            baselines = recorded['scenarios']
+        else:
+            print("Baseline was recorded with different corpora; checking ceilings only")
+
+    results = {}
+    print("Checking compositing backend parity...")
+    failures = check_backend_parity()
+    print("Checking invisible watermark round trips...")
+    failures.extend(check_invisible_roundtrip())
+    with tempfile.TemporaryDirectory(prefix='watermark-regression-') as work_dir:
+        for seed, (corpus, (count, size)) in enumerate(corpora.items()):
+            if not count:
+                continue
+            width, height = (int(v) for v in size.lower().split('x'))
+            input_dir = os.path.join(work_dir, corpus)
+            print(f"Generating {count} {corpus} images ({width}x{height})...")
+            generate_corpus(input_dir, count, width, height, seed)
+            for mode in MODES:
+                name = f"{corpus}-{mode}"
+                stats = measure(input_dir, work_dir, mode)
+                results[name] = {key: stats[key] for key in ('ms_per_image', 'p95_ms', 'max_ms', 'peak_rss_mb')}
+                failures.extend(check(name, stats, baselines.get(name), args))
+                print(f"  {name:<20} {stats['ms_per_image']:10.1f} ms/image {stats['p95_ms']:10.1f} ms p95 "
+                      f"{stats['max_ms']:10.1f} ms max {stats['peak_rss_mb']:8.0f} MB peak RSS")
+
+    if args.update_baseline:
+        with open(args.baseline, 'w', encoding='utf-8') as f:
+            json.dump({'corpora': {k: list(v) for k, v in corpora.items()}, 'scenarios': results},
+                      f, indent=2, sort_keys=True)
+            f.write('\n')
+        print(f"Baseline written to {args.baseline}")
+
+    print(f"\n{'='*50}")
+    if failures:
+        print("Regression check FAILED:")
+        for failure in failures:
+            print(f"  ✗ {failure}")
+    else:
+        print("Regression check passed")
+    print(f"{'='*50}")
+    sys.exit(1 if failures else 0)
+
+
+if __name__ == "__main__":
+    main()
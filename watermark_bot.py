@@ -1,126 +1,270 @@
 import os
-import cv2
+import io
+import hashlib
 import numpy as np
 from PIL import Image, ImageDraw, ImageFont
 import piexif
 from datetime import datetime
 import argparse
+from output_cache import OutputCache
+import invisible_payload
+import animated_watermark
+from batch_report import ImageResult, retry_call
+import composite
+from invisible_payload import INVISIBLE_MODES
+
+# Bump whenever the same settings start producing different output files (rendering,
+# encoding, metadata), so the output cache stops serving those of older versions
+RENDER_VERSION = 1
+
+def _read_bytes(path):
+    with open(path, 'rb') as f:
+        return f.read()
+
+def _write_bytes(path, data):
+    with open(path, 'wb') as f:
+        f.write(data)
 
 class WatermarkBot:
-    def __init__(self, author_name="Your Name", website="your-website.com"):
+    def __init__(self, author_name="Your Name", website="your-website.com", timestamp=None,
+                 watermark_key=None, ecc_symbols=0, composite_backend='pillow', composite_threads=None):
         """
         Initialize the watermark bot with author information
         
         Args:
             author_name (str): Your name for metadata
             website (str): Your website for metadata
+            timestamp (datetime or str): Time stamped into metadata. None uses the processing
+                time; a datetime is used as-is; 'input' derives it from the input's EXIF date
+                (or file modification time), so re-processing gives byte-identical output
+            watermark_key (str): Secret deciding where invisible watermark bits are placed
+            ecc_symbols (int): Reed-Solomon parity bytes per block for the invisible watermark
+                (0 disables error correction; requires the reedsolo package)
+            composite_backend (str): How the visible watermark is blended, 'pillow' (full-frame
+                overlay) or 'opencv' (text regions only, multithreaded); output is pixel-identical
+            composite_threads (int): OpenCV threads for the 'opencv' backend (None for OpenCV's default)
         """
+        if composite_backend not in composite.BACKENDS:
+            raise ValueError(f"Unknown compositing backend: {composite_backend}")
         self.author_name = author_name
         self.website = website
-        
-    def add_invisible_watermark(self, image_path, output_path, watermark_text="Protected"):
+        self.timestamp = timestamp
+        self.watermark_key = watermark_key
+        self.ecc_symbols = ecc_symbols
+        self.composite_backend = composite_backend
+        self.composite_threads = composite_threads
+
+    @property
+    def deterministic(self):
+        """Whether metadata timestamps are reproducible across runs"""
+        return self.timestamp is not None
+
+    def resolve_timestamp(self, input_path=None, data=None):
         """
-        Add invisible watermark using LSB (Least Significant Bit) steganography
+        Time to stamp into the metadata of an output
+
+        Args:
+            input_path (str): Path to input image, for the 'input' timestamp mode
+            data (bytes): Input file contents if already read
+
+        Returns:
+            datetime: Timestamp for the output
+        """
+        if self.timestamp is None:
+            return datetime.now()
+        if isinstance(self.timestamp, datetime):
+            return self.timestamp
+        if self.timestamp != 'input':
+            raise ValueError(f"Unsupported timestamp mode: {self.timestamp}")
+        if input_path is None and data is None:
+            raise ValueError("An input is needed to derive the timestamp from")
+        
+        # Prefer the capture date, then the last modification date from EXIF
+        try:
+            with Image.open(io.BytesIO(data) if data is not None else input_path) as img:
+                exif = img.getexif()
+                value = exif.get_ifd(piexif.ImageIFD.ExifTag).get(piexif.ExifIFD.DateTimeOriginal) \
+                    or exif.get(piexif.ImageIFD.DateTime)
+            if value:
+                return datetime.strptime(str(value).strip('\x00 '), "%Y:%m:%d %H:%M:%S")
+        except Exception:
+            pass
+        if input_path is None:
+            raise ValueError("Input has no EXIF date to derive the timestamp from")
+        return datetime.fromtimestamp(int(os.path.getmtime(input_path)))
         
+    def _png_path(self, output_path):
+        """Force a .png extension on output_path (all stages write PNG)"""
+        if not output_path.lower().endswith('.png'):
+            output_path = os.path.splitext(output_path)[0] + '.png'
+        return output_path
+
+    def load_image(self, image_path, data=None):
+        """
+        Open an image from disk
+
         Args:
             image_path (str): Path to input image
-            output_path (str): Path to save watermarked image
-            watermark_text (str): Text to embed as invisible watermark
+            data (bytes): Contents of image_path if already read
+
+        Returns:
+            PIL.Image.Image: Decoded image
         """
         # Read image using PIL for better Hebrew path support
         try:
-            pil_img = Image.open(image_path)
-            img = np.array(pil_img)
-            if len(img.shape) == 3 and img.shape[2] == 4:  # RGBA
-                img = cv2.cvtColor(img, cv2.COLOR_RGBA2BGR)
-            elif len(img.shape) == 3:  # RGB
-                img = cv2.cvtColor(img, cv2.COLOR_RGB2BGR)
-            # If grayscale, no conversion needed
+            img = Image.open(io.BytesIO(data) if data is not None else image_path)
+            img.load()
         except Exception as e:
             raise ValueError(f"Could not read image from {image_path}: {str(e)}")
-            
-        # Convert text to binary
-        binary_text = ''.join(format(ord(char), '08b') for char in watermark_text)
-        binary_text += '00000000'  # Add null terminator
-        
-        # Check if image can hold the text
-        if len(binary_text) > img.size:
-            raise ValueError("Image too small to hold watermark text")
-            
-        # Flatten image
-        flat_img = img.flatten()
-        
-        # Embed watermark in LSB
-        for i, bit in enumerate(binary_text):
-            if i < len(flat_img):
-                flat_img[i] = (flat_img[i] & 0xFE) | int(bit)
-                
-        # Reshape back to original dimensions
-        watermarked_img = flat_img.reshape(img.shape)
-        
-        # Save watermarked image using PIL for better Hebrew path support
-        if len(watermarked_img.shape) == 3:
-            watermarked_img = cv2.cvtColor(watermarked_img, cv2.COLOR_BGR2RGB)
-        pil_watermarked = Image.fromarray(watermarked_img)
-        
-        # Ensure output is PNG format
-        if not output_path.lower().endswith('.png'):
-            output_path = os.path.splitext(output_path)[0] + '.png'
-        
-        pil_watermarked.save(output_path, format='PNG')
-        print(f"Invisible watermark added: {watermark_text}")
-        
-    def add_visible_watermark(self, image_path, output_path, watermark_text="© 2024", 
-                            positions=None, opacity=70, font_size=24):
+        return img
+
+    def _invisible_source(self, img, watermark_text=""):
         """
-        Add visible watermark to image
+        Image the invisible watermark is embedded into
+
+        Converted to RGB(A) are: modes without a native carrier, CMYK (outputs are
+        PNG, which can't store it) and palettes with too few entries to hold
+        watermark_text (a 16-colour palette has no room for a frame at all).
+        """
+        if img.mode == 'P':
+            room = invisible_payload.capacity(invisible_payload.carrier_shape(img), 'P', self.ecc_symbols)
+            native = room >= max(1, len(watermark_text.encode('utf-8')))
+        else:
+            native = img.mode in INVISIBLE_MODES and img.mode != 'CMYK'
+        if not native:
+            img = img.convert('RGBA' if 'A' in img.getbands() or 'transparency' in img.info else 'RGB')
+        return img
+
+    def invisible_capacity(self, img, watermark_text=""):
+        """
+        Number of bytes of text the invisible watermark can hold in an image
+
+        Args:
+            img (PIL.Image.Image): Image to be watermarked
+            watermark_text (str): Text to be embedded (decides whether a palette is used natively)
+
+        Returns:
+            int: Capacity in bytes of UTF-8 text, with the bot's error correction level
+        """
+        img = self._invisible_source(img, watermark_text)
+        return invisible_payload.capacity(invisible_payload.carrier_shape(img), img.mode, self.ecc_symbols)
+
+    def embed_invisible(self, img, watermark_text="Protected"):
+        """
+        Embed an invisible LSB watermark into an in-memory image
+
+        The text is framed (UTF-8, length header, CRC32, optional Reed-Solomon parity) and
+        spread over every tile of the image at positions chosen by the bot's watermark key,
+        which also encrypts it; see invisible_payload. Bits are written straight into the native sample buffer: L,
+        LA, RGB, RGBA, I and I;16 images keep their mode, alpha and bit depth, and palette
+        images carry the mark in their palette entries when it has room for the text.
+        CMYK, smaller palettes and other modes are converted to RGB(A) first.
+
+        Args:
+            img (PIL.Image.Image): Image to watermark
+            watermark_text (str): Text to embed as invisible watermark
+
+        Returns:
+            PIL.Image.Image: Watermarked image
+        """
+        img = self._invisible_source(img, watermark_text)
+        buffer, carrier = invisible_payload.carrier_view(img)
+        invisible_payload.embed(carrier, img.mode, watermark_text, key=self.watermark_key,
+                                ecc_symbols=self.ecc_symbols)
+        
+        if img.mode == 'P':
+            watermarked = img.copy()
+            watermarked.putpalette(buffer.tobytes(), rawmode=img.palette.mode)
+            return watermarked
+        watermarked = Image.frombuffer(img.mode, img.size, buffer, 'raw', img.mode, 0, 1)
+        watermarked.info = dict(img.info)
+        return watermarked
+
+    def extract_invisible(self, img, search_offsets=True):
+        """
+        Read the invisible watermark back from an image
+
+        Args:
+            img (PIL.Image.Image): Watermarked image
+            search_offsets (bool): Also try every tile alignment, so cropped images are read too
+
+        Returns:
+            str: Embedded text, or None if the image carries no valid mark for this key
+        """
+        if img.mode not in INVISIBLE_MODES and img.mode != 'P':
+            return None
+        _, carrier = invisible_payload.carrier_view(img)
+        return invisible_payload.extract(carrier, img.mode, key=self.watermark_key,
+                                         search_offsets=search_offsets)
+
+    def verify_invisible(self, img, watermark_text=None, search_offsets=False):
+        """
+        Fast accept/reject check for the invisible watermark
+
+        Args:
+            img (PIL.Image.Image): Image to check
+            watermark_text (str): Expected text, or None to accept any valid mark
+            search_offsets (bool): Also accept marks in cropped images (slower)
+
+        Returns:
+            bool: Whether the image carries a valid (and matching) mark
+        """
+        text = self.extract_invisible(img, search_offsets=search_offsets)
+        return text is not None and (watermark_text is None or text == watermark_text)
+
+    def add_invisible_watermark(self, image_path, output_path, watermark_text="Protected"):
+        """
+        Add invisible watermark using LSB (Least Significant Bit) steganography
         
         Args:
             image_path (str): Path to input image
             output_path (str): Path to save watermarked image
-            watermark_text (str): Text to display as watermark
-            position (str): Position of watermark ('top-left', 'top-right', 'bottom-left', 'bottom-right', 'center')
-            opacity (float): Opacity of watermark (0.0 to 1.0)
-            font_size (int): Font size for watermark text
+            watermark_text (str): Text to embed as invisible watermark
         """
-        # Open image
-        img = Image.open(image_path)
-        
-        # Create a copy for watermark
-        watermarked = img.copy()
-        
-        # Create transparent overlay
-        overlay = Image.new('RGBA', img.size, (0, 0, 0, 0))
-        draw = ImageDraw.Draw(overlay)
+        img = self.load_image(image_path)
+        print(f"Invisible watermark capacity: {self.invisible_capacity(img, watermark_text)} bytes")
+        pil_watermarked = self.embed_invisible(img, watermark_text)
         
+        # Save watermarked image using PIL for better Hebrew path support
+        pil_watermarked.save(self._png_path(output_path), format='PNG')
+        print(f"Invisible watermark added: {watermark_text}")
+
+    def _load_font(self, font_size):
+        """Load the watermark font, falling back to Pillow's default font"""
         # Try to use a default font, fallback to default if not available
         try:
-            font = ImageFont.truetype("arial.ttf", font_size)
+            return ImageFont.truetype("arial.ttf", font_size)
         except:
             try:
-                font = ImageFont.truetype("/System/Library/Fonts/Arial.ttf", font_size)
+                return ImageFont.truetype("/System/Library/Fonts/Arial.ttf", font_size)
             except:
-                font = ImageFont.load_default()
+                return ImageFont.load_default()
+
+    def _text_layout(self, size, watermark_text, positions, font_size):
+        """
+        Font, text bounding box and top-left text origins for each watermark position
+
+        Returns:
+            tuple: (font, bbox, list of (x, y) origins)
+        """
+        font = self._load_font(font_size)
         
         # Get text size
-        bbox = draw.textbbox((0, 0), watermark_text, font=font)
+        bbox = ImageDraw.Draw(Image.new('RGBA', (1, 1))).textbbox((0, 0), watermark_text, font=font)
         text_width = bbox[2] - bbox[0]
         text_height = bbox[3] - bbox[1]
         
         # Get image dimensions
-        img_width, img_height = img.size
+        img_width, img_height = size
         
         # Calculate margin based on font size (minimum 10px, scales with font size)
         margin = max(10, font_size // 3)
         
-        # Convert opacity from percentage to decimal (0-100 to 0-1)
-        opacity_decimal = opacity / 100.0
-        
         # Default to bottom-right if no positions specified
         if positions is None:
             positions = ['bottom-right']
         
-        # Draw watermark text at each selected position
+        origins = []
         for position in positions:
             if position == 'top-left':
                 x, y = margin, margin
@@ -132,8 +276,101 @@ class WatermarkBot:
                 x, y = img_width - text_width - margin, img_height - text_height - margin
             elif position == 'center':
                 x, y = (img_width - text_width) // 2, (img_height - text_height) // 2
-            
-            # Draw watermark text at this position
+            else:
+                continue
+            origins.append((x, y))
+        return font, bbox, origins
+
+    def render_mark_patches(self, size, watermark_text="© 2024", positions=None, opacity=70, font_size=24):
+        """
+        Pre-render the visible watermark as small RGBA patches for frames of a given size
+
+        Drawing the text once and blending only the patches keeps per-frame work to the
+        watermark's own area, which matters when the same mark goes on many frames.
+
+        Args:
+            size (tuple): (width, height) of the frames
+            watermark_text (str): Text to display as watermark
+            positions (list): Positions of watermark
+            opacity (int): Opacity percentage of watermark (0-100)
+            font_size (int): Font size for watermark text
+
+        Returns:
+            list: (x, y, patch) tuples, patch being an (h, w, 4) uint8 array whose top-left
+            corner goes at (x, y); patches are clipped to the frame
+        """
+        font, bbox, origins = self._text_layout(size, watermark_text, positions, font_size)
+        fill = (255, 255, 255, int(255 * (opacity / 100.0)))
+        
+        # Region of the frame each text covers, clipped to the frame
+        groups = []
+        for index, (x, y) in enumerate(origins):
+            box = (max(0, x + bbox[0]), max(0, y + bbox[1]), min(size[0], x + bbox[2]), min(size[1], y + bbox[3]))
+            if box[2] > box[0] and box[3] > box[1]:
+                groups.append((box, [index]))
+        
+        # Overlapping texts share a patch, drawn in order as on a full overlay, so
+        # blending the patches one by one gives the same pixels as compositing the overlay
+        merged = True
+        while merged:
+            merged = False
+            for i in range(len(groups)):
+                for j in range(i + 1, len(groups)):
+                    a, b = groups[i][0], groups[j][0]
+                    if a[0] < b[2] and b[0] < a[2] and a[1] < b[3] and b[1] < a[3]:
+                        box = (min(a[0], b[0]), min(a[1], b[1]), max(a[2], b[2]), max(a[3], b[3]))
+                        groups[i] = (box, groups[i][1] + groups[j][1])
+                        del groups[j]
+                        merged = True
+                        break
+                if merged:
+                    break
+        
+        patches = []
+        for (left, top, right, bottom), members in groups:
+            patch = Image.new('RGBA', (right - left, bottom - top), (0, 0, 0, 0))
+            draw = ImageDraw.Draw(patch)
+            for index in sorted(members):
+                x, y = origins[index]
+                draw.text((x - left, y - top), watermark_text, font=font, fill=fill)
+            patches.append((left, top, np.array(patch)))
+        return patches
+
+    def render_visible(self, img, watermark_text="© 2024", positions=None, opacity=70, font_size=24):
+        """
+        Composite a visible text watermark onto an in-memory image
+
+        Args:
+            img (PIL.Image.Image): Image to watermark
+            watermark_text (str): Text to display as watermark
+            positions (list): Positions of watermark ('top-left', 'top-right', 'bottom-left', 'bottom-right', 'center')
+            opacity (int): Opacity percentage of watermark (0-100)
+            font_size (int): Font size for watermark text
+
+        Returns:
+            PIL.Image.Image: Watermarked image
+        """
+        if self.composite_backend == 'opencv':
+            # Only the text's bounding boxes are drawn and blended; see composite
+            composite.set_threads(self.composite_threads)
+            frame = composite.to_rgba_array(img)
+            for x, y, patch in self.render_mark_patches(img.size, watermark_text, positions,
+                                                        opacity=opacity, font_size=font_size):
+                height, width = patch.shape[:2]
+                composite.blend_into(frame[y:y + height, x:x + width], patch)
+            return Image.fromarray(frame, 'RGBA')
+        
+        # Create transparent overlay
+        overlay = Image.new('RGBA', img.size, (0, 0, 0, 0))
+        draw = ImageDraw.Draw(overlay)
+        
+        font, _, origins = self._text_layout(img.size, watermark_text, positions, font_size)
+        
+        # Convert opacity from percentage to decimal (0-100 to 0-1)
+        opacity_decimal = opacity / 100.0
+        
+        # Draw watermark text at each selected position
+        for x, y in origins:
             draw.text((x, y), watermark_text, font=font, fill=(255, 255, 255, int(255 * opacity_decimal)))
         
         # Composite overlay onto image
@@ -144,26 +381,43 @@ class WatermarkBot:
         # Convert back to RGB if original was RGB
         if img.mode == 'RGB':
             watermarked = watermarked.convert('RGB')
+        return watermarked
         
-        # Ensure output is PNG format
-        if not output_path.lower().endswith('.png'):
-            output_path = os.path.splitext(output_path)[0] + '.png'
-        
-        # Save watermarked image
-        watermarked.save(output_path, format='PNG')
-        print(f"Visible watermark added: {watermark_text}")
-        
-    def add_metadata(self, image_path, output_path):
+    def add_visible_watermark(self, image_path, output_path, watermark_text="© 2024", 
+                            positions=None, opacity=70, font_size=24):
         """
-        Add metadata (EXIF) to image with author information
+        Add visible watermark to image
         
         Args:
             image_path (str): Path to input image
-            output_path (str): Path to save image with metadata
+            output_path (str): Path to save watermarked image
+            watermark_text (str): Text to display as watermark
+            position (str): Position of watermark ('top-left', 'top-right', 'bottom-left', 'bottom-right', 'center')
+            opacity (float): Opacity of watermark (0.0 to 1.0)
+            font_size (int): Font size for watermark text
         """
         # Open image
         img = Image.open(image_path)
         
+        watermarked = self.render_visible(img, watermark_text, positions, opacity, font_size)
+        
+        # Save watermarked image
+        watermarked.save(self._png_path(output_path), format='PNG')
+        print(f"Visible watermark added: {watermark_text}")
+
+    def build_exif(self, timestamp=None):
+        """
+        Build EXIF bytes carrying author information
+
+        Args:
+            timestamp (datetime): Time to stamp, defaults to resolve_timestamp()
+
+        Returns:
+            bytes: EXIF block suitable for PIL's save(exif=...)
+        """
+        if timestamp is None:
+            timestamp = self.resolve_timestamp()
+        
         # Prepare EXIF data
         exif_dict = {"0th": {}, "Exif": {}, "GPS": {}, "1st": {}, "thumbnail": None}
         
@@ -171,7 +425,7 @@ class WatermarkBot:
         exif_dict["0th"][piexif.ImageIFD.Artist] = self.author_name.encode('utf-8')
         
         # Add copyright
-        copyright_text = f"© {datetime.now().year} {self.author_name}"
+        copyright_text = f"© {timestamp.year} {self.author_name}"
         exif_dict["0th"][piexif.ImageIFD.Copyright] = copyright_text.encode('utf-8')
         
         # Add software
@@ -182,24 +436,319 @@ class WatermarkBot:
         exif_dict["Exif"][piexif.ExifIFD.UserComment] = user_comment
         
         # Add date/time
-        current_time = datetime.now().strftime("%Y:%m:%d %H:%M:%S")
+        current_time = timestamp.strftime("%Y:%m:%d %H:%M:%S")
         exif_dict["0th"][piexif.ImageIFD.DateTime] = current_time.encode('utf-8')
         
         # Convert to EXIF bytes
-        exif_bytes = piexif.dump(exif_dict)
+        return piexif.dump(exif_dict)
         
-        # Ensure output is PNG format
-        if not output_path.lower().endswith('.png'):
-            output_path = os.path.splitext(output_path)[0] + '.png'
+    def add_metadata(self, image_path, output_path):
+        """
+        Add metadata (EXIF) to image with author information
+        
+        Args:
+            image_path (str): Path to input image
+            output_path (str): Path to save image with metadata
+        """
+        # Open image
+        img = Image.open(image_path)
         
         # Save image with EXIF data
-        img.save(output_path, format='PNG', exif=exif_bytes)
+        exif = self.build_exif(self.resolve_timestamp(image_path))
+        img.save(self._png_path(output_path), format='PNG', exif=exif)
         print(f"Metadata added: Author={self.author_name}, Website={self.website}")
+
+    def watermark_frame(self, img, add_invisible=True, add_visible=True, visible_text="© 2024",
+                        visible_positions=None, font_size=24, opacity=70, invisible_text="Protected"):
+        """
+        Apply the pixel stages (invisible, then visible) to an in-memory image
+
+        Args:
+            img (PIL.Image.Image): Decoded input image
+            add_invisible (bool): Whether to add invisible watermark
+            add_visible (bool): Whether to add visible watermark
+            visible_text (str): Text for visible watermark
+            visible_positions (list): Positions of visible watermark
+            font_size (int): Font size for visible watermark
+            opacity (int): Opacity percentage for visible watermark
+            invisible_text (str): Text to embed as invisible watermark
+
+        Returns:
+            PIL.Image.Image: Watermarked image
+        """
+        if add_invisible and add_visible and img.mode not in ('RGB', 'RGBA'):
+            # The visible stage composites in RGBA; embed in that frame so the mark survives it.
+            # RGB keeps its colour samples in RGBA, so it is embedded in its own, contiguous buffer
+            img = img.convert('RGBA')
+        if add_invisible:
+            img = self.embed_invisible(img, invisible_text)
+        if add_visible:
+            img = self.render_visible(img, visible_text, visible_positions, opacity=opacity, font_size=font_size)
+        return img
+
+    def _rendition_path(self, output_path, max_edge):
+        return f"{os.path.splitext(self._png_path(output_path))[0]}_{max_edge}.png"
+
+    def output_files(self, output_path, renditions=None):
+        """
+        Files written for one output, as used by the output cache
+
+        Returns:
+            dict: Maps a stable file name to its path on disk
+        """
+        files = {'output.png': self._png_path(output_path)}
+        for max_edge in renditions or []:
+            files[f'rendition_{max_edge}.png'] = self._rendition_path(output_path, max_edge)
+        return files
+
+    def output_settings(self, timestamp=None, **kwargs):
+        """
+        Everything besides the input pixels that determines an output, for cache keys
+
+        Args:
+            timestamp (datetime): Timestamp the output is stamped with
+            **kwargs: Arguments passed to process_image
+
+        Returns:
+            dict: JSON-serialisable settings
+        """
+        settings = dict(kwargs, author_name=self.author_name, website=self.website,
+                        render_version=RENDER_VERSION)
+        if kwargs.get('add_invisible', True):
+            # The key, ECC level and payload format decide the embedded bits; the key is a
+            # secret, so only its hash is kept
+            settings['watermark_key'] = None if self.watermark_key is None else \
+                hashlib.sha256(self.watermark_key.encode('utf-8')).hexdigest()
+            settings['ecc_symbols'] = self.ecc_symbols
+            settings['payload_version'] = invisible_payload.VERSION
+        if kwargs.get('add_metadata', True):
+            settings['timestamp'] = timestamp.isoformat() if timestamp else None
+        return settings
+
+    def _save_renditions(self, img, output_path, renditions, exif=None):
+        """Save downscaled copies of img next to output_path as <name>_<edge>.png"""
+        paths = []
+        for max_edge in sorted(renditions, reverse=True):
+            rendition = img.copy()
+            # reducing_gap lets Pillow shrink by whole factors before the final resample
+            rendition.thumbnail((max_edge, max_edge), Image.LANCZOS, reducing_gap=3.0)
+            path = self._rendition_path(output_path, max_edge)
+            if exif:
+                rendition.save(path, format='PNG', exif=exif)
+            else:
+                rendition.save(path, format='PNG')
+            paths.append(path)
+            # Chain the downscales so each one starts from the next larger rendition
+            img = rendition
+        return paths
+
+    def save_image(self, img, output_path, add_metadata=True, renditions=None, timestamp=None):
+        """
+        Encode an in-memory image to PNG, optionally with author EXIF
+
+        Args:
+            img (PIL.Image.Image): Image to save
+            output_path (str): Path to save image (extension forced to .png)
+            add_metadata (bool): Whether to embed author metadata
+            renditions (list): Max edge lengths of downscaled copies to save alongside,
+                as <name>_<edge>.png
+            timestamp (datetime): Time to stamp into the metadata
+
+        Returns:
+            str: Path the image was written to
+        """
+        output_path = self._png_path(output_path)
+        exif = self.build_exif(timestamp) if add_metadata else None
+        if exif:
+            img.save(output_path, format='PNG', exif=exif)
+        else:
+            img.save(output_path, format='PNG')
+        if renditions:
+            self._save_renditions(img, output_path, renditions, exif)
+        return output_path
+
+    def process_motion(self, kind, input_path, output_path, motion_options=None, data=None, **kwargs):
+        """
+        Watermark an animation or video frame by frame
+
+        Renditions and the output cache apply to still images only.
+
+        Args:
+            kind (str): 'animation' or 'video', from animated_watermark.motion_kind
+            input_path (str): Path to input file
+            output_path (str): Path to save to; the extension follows the input's format
+            motion_options (dict): Extra arguments for animated_watermark
+            data (bytes): Contents of an animation's input_path if already read
+            **kwargs: Watermark arguments of process_image
+
+        Returns:
+            tuple: (path written, number of frames, list of warnings, e.g. a skipped invisible mark)
+        """
+        options = dict(motion_options or {})
+        if kind == 'video':
+            mark = animated_watermark.watermark_video
+        else:
+            mark = animated_watermark.watermark_animation
+            # Encoder settings only apply to video
+            options.pop('video_codec', None)
+            options.pop('crf', None)
+            options['data'] = data
+        return mark(self, input_path, output_path, timestamp=self.resolve_timestamp(input_path, data),
+                    **kwargs, **options)
+
+    def load_preview(self, image_path, max_edge=512, data=None):
+        """
+        Decode a downscaled copy of an image for previews
+
+        JPEG inputs use Pillow's draft mode, which scales in the DCT domain while
+        decoding, so the full-resolution image is never materialised.
+
+        Args:
+            image_path (str): Path to input image
+            max_edge (int): Longest edge of the preview
+            data (bytes): Contents of image_path if already read
+
+        Returns:
+            tuple: (preview image, scale factor relative to the full image)
+        """
+        try:
+            img = Image.open(io.BytesIO(data) if data is not None else image_path)
+            full_width = img.width
+            if img.format == 'JPEG':
+                img.draft('RGB', (max_edge, max_edge))
+            img.thumbnail((max_edge, max_edge), Image.LANCZOS, reducing_gap=3.0)
+        except Exception as e:
+            raise ValueError(f"Could not read image from {image_path}: {str(e)}")
+        return img, img.width / full_width
+
+    def render_preview(self, preview, scale, visible_text="© 2024", visible_positions=None,
+                       font_size=24, opacity=70):
+        """
+        Draw the visible watermark on a preview as it will look on the full image
+
+        Args:
+            preview (PIL.Image.Image): Image returned by load_preview
+            scale (float): Scale factor returned by load_preview
+            visible_text (str): Text for visible watermark
+            visible_positions (list): Positions of visible watermark
+            font_size (int): Font size for visible watermark at full resolution
+            opacity (int): Opacity percentage for visible watermark
+
+        Returns:
+            PIL.Image.Image: Preview with the visible watermark applied
+        """
+        return self.render_visible(preview, visible_text, visible_positions, opacity=opacity,
+                                   font_size=max(1, round(font_size * scale)))
+        
+    def copies_unchanged(self, add_invisible=True, add_visible=True, add_metadata=True, renditions=None, **kwargs):
+        """Whether a job with these process_image settings just copies its input to the output"""
+        return not (add_invisible or add_visible or add_metadata or renditions)
+
+    def start_job(self, result, data, cache=None, motion_options=None, retries=2, add_invisible=True,
+                  add_visible=True, add_metadata=True, visible_text="© 2024", visible_positions=None,
+                  font_size=24, opacity=70, renditions=None, preview_only=False, invisible_text="Protected"):
+        """
+        Run the steps of a job that come before its input is decoded
+
+        Saves previews, copies the input when there is nothing to do, marks animations
+        in one go and serves cache hits. Anything else is a still image, which the caller
+        decodes, passes through watermark_frame and hands to finish_job, so the pixel work
+        can run wherever the caller likes (a writer thread, another process).
+
+        Args:
+            result (ImageResult): The job; its input and output paths are used and its outcome recorded
+            data (bytes): Contents of the input
+            cache, motion_options, retries, add_invisible, add_visible, add_metadata, visible_text,
+            visible_positions, font_size, opacity, renditions, preview_only, invisible_text:
+                Same as process_image
+
+        Returns:
+            tuple: (timestamp, cache_key) to pass to finish_job, or None when the job is done
+        """
+        input_path, output_path = result.input_path, result.output_path
+        result.input_bytes = len(data)
+        frame_kwargs = dict(add_invisible=add_invisible, add_visible=add_visible, visible_text=visible_text,
+                            visible_positions=visible_positions, font_size=font_size, opacity=opacity,
+                            invisible_text=invisible_text)
+
+        if preview_only:
+            if not renditions:
+                raise ValueError("preview_only requires at least one rendition size")
+            if animated_watermark.motion_kind(input_path) == 'video':
+                raise ValueError("preview_only does not apply to video")
+            with result.timed('process'):
+                img, scale = self.load_preview(input_path, max(renditions), data)
+                if add_visible:
+                    img = self.render_preview(img, scale, visible_text, visible_positions,
+                                              font_size=font_size, opacity=opacity)
+            exif = self.build_exif(self.resolve_timestamp(input_path, data)) if add_metadata else None
+            with result.timed('save'):
+                paths = retry_call(lambda: self._save_renditions(img, output_path, renditions, exif),
+                                   result, retries)
+            result.output_path = paths[-1]
+            result.record_outputs(paths)
+            return None
+
+        if self.copies_unchanged(add_invisible, add_visible, add_metadata, renditions):
+            # Nothing to do, so the input is written out as it is
+            with result.timed('save'):
+                retry_call(lambda: _write_bytes(output_path, data), result, retries)
+            result.output_bytes = len(data)
+            return None
+
+        if animated_watermark.motion_kind(input_path, data) == 'animation':
+            with result.timed('process'):
+                result.output_path, _, result.warnings = self.process_motion(
+                    'animation', input_path, output_path, motion_options=motion_options, data=data,
+                    add_metadata=add_metadata, **frame_kwargs)
+            result.record_outputs([result.output_path])
+            return None
+
+        timestamp = self.resolve_timestamp(input_path, data)
+        cache_key = None
+        if cache is not None:
+            settings = self.output_settings(timestamp, add_metadata=add_metadata, renditions=renditions,
+                                            **frame_kwargs)
+            cache_key = cache.key(data, settings)
+            files = self.output_files(output_path, renditions)
+            if cache.fetch(cache_key, files):
+                result.status = 'cached'
+                result.output_path = files['output.png']
+                result.record_outputs(files.values())
+                return None
+        return timestamp, cache_key
+
+    def finish_job(self, result, img, timestamp, cache=None, cache_key=None, add_metadata=True,
+                   renditions=None, retries=2):
+        """
+        Save a still image watermarked after start_job and store its files in the cache
+
+        Args:
+            result (ImageResult): The job; its output path is used and its outcome recorded
+            img (PIL.Image.Image): Output of watermark_frame
+            timestamp, cache_key: As returned by start_job
+            cache, add_metadata, renditions, retries: Same as process_image
+        """
+        output_path = result.output_path
+        with result.timed('save'):
+            result.output_path = retry_call(
+                lambda: self.save_image(img, output_path, add_metadata=add_metadata,
+                                        renditions=renditions, timestamp=timestamp),
+                result, retries)
+        files = self.output_files(output_path, renditions)
+        result.record_outputs(files.values())
+        if cache_key is not None:
+            cache.store(cache_key, files)
         
     def process_image(self, input_path, output_path, add_invisible=True, add_visible=True, 
-                     add_metadata=True, visible_text="© 2024", visible_positions=None, font_size=24, opacity=70):
+                     add_metadata=True, visible_text="© 2024", visible_positions=None, font_size=24, opacity=70,
+                     renditions=None, preview_only=False, cache=None, invisible_text="Protected",
+                     motion_options=None, retries=2):
         """
         Process image with all watermark types
+
+        Animated GIF/APNG/WebP and video inputs are watermarked frame by frame
+        (see animated_watermark) and keep their format.
         
         Args:
             input_path (str): Path to input image
@@ -210,45 +759,92 @@ class WatermarkBot:
             visible_text (str): Text for visible watermark
             visible_position (str): Position of visible watermark
             font_size (int): Font size for visible watermark
+            renditions (list): Max edge lengths of downscaled copies to save as <name>_<edge>.png
+            preview_only (bool): Only save the renditions, decoding at reduced size where possible
+            cache (OutputCache): Serve repeated requests from, and store results in, this cache
+            invisible_text (str): Text to embed as invisible watermark
+            motion_options (dict): Extra arguments for animations and video, e.g.
+                keyframe_interval, frame_workers, video_codec, crf
+            retries (int): Times to retry reading the input and writing the output on
+                transient I/O errors
+
+        Returns:
+            ImageResult: Status, timings and sizes; errors are reported here, not raised
         """
-        temp_path = input_path
-        
+        result = ImageResult(input_path, output_path)
+        options = dict(add_invisible=add_invisible, add_visible=add_visible, add_metadata=add_metadata,
+                       visible_text=visible_text, visible_positions=visible_positions,
+                       font_size=font_size, opacity=opacity, invisible_text=invisible_text)
         try:
-            # Add invisible watermark
-            if add_invisible:
-                temp_invisible = f"temp_invisible_{os.path.basename(input_path)}"
-                self.add_invisible_watermark(temp_path, temp_invisible)
-                temp_path = temp_invisible
-            
-            # Add visible watermark
-            if add_visible:
-                temp_visible = f"temp_visible_{os.path.basename(input_path)}"
-                self.add_visible_watermark(temp_path, temp_visible, visible_text, visible_positions, font_size=font_size, opacity=opacity)
-                temp_path = temp_visible
+            if (animated_watermark.motion_kind(input_path) == 'video' and not preview_only and
+                    not self.copies_unchanged(renditions=renditions, **options)):
+                # Streamed through ffmpeg, so the input is never read here
+                with result.timed('process'):
+                    result.output_path, frames, result.warnings = self.process_motion(
+                        'video', input_path, output_path, motion_options=motion_options, **options)
+                result.input_bytes = os.path.getsize(input_path)
+                result.record_outputs([result.output_path])
+                print(f"Video processed successfully: {result.output_path} ({frames} frames)")
+                for warning in result.warnings:
+                    print(f"Note: {warning}")
+                return result
+
+            with result.timed('read'):
+                data = retry_call(lambda: _read_bytes(input_path), result, retries)
+            job = self.start_job(result, data, cache=cache, motion_options=motion_options, retries=retries,
+                                 renditions=renditions, preview_only=preview_only, **options)
+            if job is not None:
+                timestamp, cache_key = job
+                # Stages are chained in memory, so nothing is written besides the output
+                with result.timed('process'):
+                    img = self.load_image(input_path, data)
+                    img = self.watermark_frame(img, add_invisible, add_visible, visible_text,
+                                               visible_positions, font_size=font_size, opacity=opacity,
+                                               invisible_text=invisible_text)
+                self.finish_job(result, img, timestamp, cache=cache, cache_key=cache_key,
+                                add_metadata=add_metadata, renditions=renditions, retries=retries)
             
-            # Add metadata
-            if add_metadata:
-                self.add_metadata(temp_path, output_path)
+            if preview_only:
+                for max_edge in sorted(renditions, reverse=True):
+                    print(f"Preview saved: {self._rendition_path(output_path, max_edge)}")
+            elif result.status == 'cached':
+                print(f"Image served from cache: {result.output_path}")
             else:
-                # If no metadata, just copy the last temp file to output
-                import shutil
-                shutil.copy2(temp_path, output_path)
-                
-            # Clean up temp files
-            if add_invisible and os.path.exists(f"temp_invisible_{os.path.basename(input_path)}"):
-                os.remove(f"temp_invisible_{os.path.basename(input_path)}")
-            if add_visible and os.path.exists(f"temp_visible_{os.path.basename(input_path)}"):
-                os.remove(f"temp_visible_{os.path.basename(input_path)}")
-                
-            print(f"Image processed successfully: {output_path}")
+                print(f"Image processed successfully: {result.output_path}")
+            for warning in result.warnings:
+                print(f"Note: {warning}")
             
         except Exception as e:
+            result.fail(e)
             print(f"Error processing image: {str(e)}")
-            # Clean up temp files on error
-            for temp_file in [f"temp_invisible_{os.path.basename(input_path)}", 
-                            f"temp_visible_{os.path.basename(input_path)}"]:
-                if os.path.exists(temp_file):
-                    os.remove(temp_file)
+        return result
+
+def resolve_timestamp_mode(args):
+    """Map the --timestamp/--deterministic options to WatermarkBot's timestamp argument"""
+    if args.timestamp is not None:
+        return args.timestamp
+    if args.deterministic:
+        return 'input'
+    return None
+
+def parse_renditions(value):
+    """Parse a comma-separated list of rendition sizes for argparse"""
+    try:
+        sizes = [int(size) for size in value.split(',') if size.strip()]
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"invalid rendition sizes: {value}")
+    if not sizes or min(sizes) <= 0:
+        raise argparse.ArgumentTypeError(f"invalid rendition sizes: {value}")
+    return sizes
+
+def motion_options(args):
+    """Collect the animation/video options from parsed arguments"""
+    return {
+        'keyframe_interval': args.keyframe_interval,
+        'frame_workers': args.frame_workers,
+        'video_codec': args.video_codec,
+        'crf': args.crf,
+    }
 
 def main():
     # Set up proper encoding for Windows with Hebrew characters
@@ -264,13 +860,17 @@ def main():
     
     parser = argparse.ArgumentParser(description='Watermark Bot - Add watermarks and metadata to images')
     parser.add_argument('--input', required=True, help='Path to input image')
-    parser.add_argument('--output', required=True, help='Path to output image')
+    parser.add_argument('--output', help='Path to output image')
     parser.add_argument('--author', default='Your Name', help='Author name for metadata')
     parser.add_argument('--website', default='your-website.com', help='Website for metadata')
     parser.add_argument('--no-invisible', action='store_true', help='Skip invisible watermark')
     parser.add_argument('--no-visible', action='store_true', help='Skip visible watermark')
     parser.add_argument('--no-metadata', action='store_true', help='Skip metadata')
     parser.add_argument('--visible-text', default='© 2024', help='Text for visible watermark')
+    parser.add_argument('--invisible-text', default='Protected', help='Text to embed as invisible watermark')
+    parser.add_argument('--watermark-key', default=None, help='Secret deciding where invisible watermark bits are placed (needed again to read them)')
+    parser.add_argument('--ecc', type=int, default=0, help='Reed-Solomon parity bytes per block for the invisible watermark (default: 0, needs reedsolo)')
+    parser.add_argument('--extract', action='store_true', help='Print the invisible watermark of --input instead of watermarking it')
     parser.add_argument('--top-left', action='store_true', help='Add watermark to top-left position')
     parser.add_argument('--top-right', action='store_true', help='Add watermark to top-right position')
     parser.add_argument('--bottom-left', action='store_true', help='Add watermark to bottom-left position')
@@ -278,11 +878,45 @@ def main():
     parser.add_argument('--center', action='store_true', help='Add watermark to center position')
     parser.add_argument('--font-size', type=int, default=24, help='Font size for visible watermark')
     parser.add_argument('--opacity', type=int, default=70, help='Opacity percentage for visible watermark (0-100)')
+    parser.add_argument('--deterministic', action='store_true', help='Derive the metadata timestamp from the input (EXIF date or modification time) so re-runs give identical files')
+    parser.add_argument('--timestamp', type=datetime.fromisoformat, default=None, help='Fixed metadata timestamp, e.g. "2024-01-01 00:00:00" (implies reproducible output)')
+    parser.add_argument('--cache-dir', default=None, help='Serve repeated requests from a content-addressed output cache in this directory')
+    parser.add_argument('--cache-mb', type=int, default=1024, help='Size limit of the output cache in MiB (default: 1024)')
+    parser.add_argument('--renditions', type=parse_renditions, default=None, help='Comma-separated max edge sizes of downscaled copies to save alongside the output, e.g. 1920,640')
+    parser.add_argument('--preview-only', action='store_true', help='Only save the --renditions, decoding JPEGs at reduced size')
+    parser.add_argument('--composite-backend', choices=composite.BACKENDS, default='pillow', help='How the visible watermark is blended: pillow (full-frame overlay) or opencv (text regions only, multithreaded); output is identical (default: pillow)')
+    parser.add_argument('--composite-threads', type=int, default=None, help='OpenCV threads for --composite-backend opencv (default: OpenCV decides)')
+    parser.add_argument('--retries', type=int, default=2, help='Retries for transient I/O errors when reading and writing (default: 2)')
+    parser.add_argument('--keyframe-interval', type=int, default=1, help='For animations and video, embed the invisible watermark on every Nth frame (default: 1)')
+    parser.add_argument('--frame-workers', type=int, default=None, help='Threads watermarking animation and video frames (default: CPU count)')
+    parser.add_argument('--video-codec', default='libx264', help='ffmpeg encoder for video output; the invisible watermark needs a lossless one such as ffv1, or libx264rgb (always run at crf 0 while the invisible watermark is on) (default: libx264)')
+    parser.add_argument('--crf', type=int, default=18, help='Constant rate factor for the video encoder; libx264rgb is only lossless at 0 (default: 18)')
     
     args = parser.parse_args()
+    if not args.extract and not args.output:
+        parser.error("--output is required unless --extract is given")
+    
     
     # Create watermark bot
-    bot = WatermarkBot(author_name=args.author, website=args.website)
+    bot = WatermarkBot(author_name=args.author, website=args.website,
+                       timestamp=resolve_timestamp_mode(args),
+                       watermark_key=args.watermark_key, ecc_symbols=args.ecc,
+                       composite_backend=args.composite_backend,
+                       composite_threads=args.composite_threads)
+    
+    if args.extract:
+        text = bot.extract_invisible(bot.load_image(args.input))
+        if text is None:
+            print("No invisible watermark found")
+            sys.exit(1)
+        print(f"Invisible watermark: {text}")
+        return
+    
+    cache = None
+    if args.cache_dir:
+        if not bot.deterministic and not args.no_metadata:
+            parser.error("--cache-dir needs --deterministic or --timestamp when metadata is added")
+        cache = OutputCache(args.cache_dir, max_bytes=args.cache_mb * 1024 * 1024)
     
     # Build positions list from command line arguments
     positions = []
@@ -302,7 +936,7 @@ def main():
         positions = ['bottom-right']
     
     # Process image
-    bot.process_image(
+    result = bot.process_image(
         input_path=args.input,
         output_path=args.output,
         add_invisible=not args.no_invisible,
@@ -311,8 +945,16 @@ def main():
         visible_text=args.visible_text,
         visible_positions=positions,
         font_size=args.font_size,
-        opacity=args.opacity
+        opacity=args.opacity,
+        renditions=args.renditions,
+        preview_only=args.preview_only,
+        cache=cache,
+        invisible_text=args.invisible_text,
+        motion_options=motion_options(args),
+        retries=args.retries
     )
+    if not result.ok:
+        sys.exit(1)
 
 if __name__ == "__main__":
     main() 
\ No newline at end of file
@@ -2,13 +2,21 @@ import tkinter as tk
 from tkinter import ttk, filedialog, messagebox
 import os
 import glob
+from PIL import ImageTk
 from watermark_bot import WatermarkBot
+from batch_report import BatchReport
+
+# Longest edge of the live preview, in pixels
+PREVIEW_EDGE = 420
+
+# Per-image results of batch runs, written to the output directory
+REPORT_NAME = "watermark_report.jsonl"
 
 class WatermarkBotGUI:
     def __init__(self, root):
         self.root = root
         self.root.title("Watermark Bot")
-        self.root.geometry("700x675")
+        self.root.geometry("1150x675")
         
         # Initialize watermark bot
         self.bot = WatermarkBot()
@@ -34,8 +42,24 @@ class WatermarkBotGUI:
         self.add_visible = tk.BooleanVar(value=True)
         self.add_metadata = tk.BooleanVar(value=True)
         
+        # Live preview state: the decoded preview is cached per input file, so
+        # setting changes only redraw the watermark on the small image
+        self._preview_source = None
+        self._preview_base = None
+        self._preview_photo = None
+        self._preview_job = None
+        # First image of the input directory, looked up when the directory changes
+        # rather than on every redraw
+        self._batch_preview_file = ""
+        
         self.create_widgets()
         
+        for var in (self.processing_mode, self.input_path, self.visible_text,
+                    self.top_left, self.top_right, self.bottom_left, self.bottom_right, self.center,
+                    self.font_size, self.opacity, self.add_visible):
+            var.trace_add('write', self.schedule_preview)
+        self.input_dir.trace_add('write', self.on_input_dir_change)
+        
     def create_widgets(self):
         # Main frame
         main_frame = ttk.Frame(self.root, padding="10")
@@ -136,6 +160,12 @@ class WatermarkBotGUI:
         self.status_label = ttk.Label(main_frame, text="Ready to process images")
         self.status_label.grid(row=6, column=0, columnspan=3)
         
+        # Live preview
+        preview_frame = ttk.LabelFrame(main_frame, text="Preview", padding="10")
+        preview_frame.grid(row=1, column=3, rowspan=6, sticky=(tk.N, tk.S, tk.W, tk.E), padx=(10, 0))
+        self.preview_label = ttk.Label(preview_frame, text="Select an image to preview", anchor=tk.CENTER)
+        self.preview_label.grid(row=0, column=0)
+        
         # Initialize mode
         self.on_mode_change()
         
@@ -189,6 +219,73 @@ class WatermarkBotGUI:
         if directory:
             self.output_dir.set(directory)
     
+    def get_selected_positions(self):
+        """Build positions list from checkboxes"""
+        positions = []
+        if self.top_left.get():
+            positions.append('top-left')
+        if self.top_right.get():
+            positions.append('top-right')
+        if self.bottom_left.get():
+            positions.append('bottom-left')
+        if self.bottom_right.get():
+            positions.append('bottom-right')
+        if self.center.get():
+            positions.append('center')
+        
+        # Default to bottom-right if no positions selected
+        if not positions:
+            positions = ['bottom-right']
+        return positions
+    
+    def on_input_dir_change(self, *args):
+        """Pick the image previewed in batch mode, then refresh the preview"""
+        input_dir = self.input_dir.get()
+        image_files = self.get_supported_image_files(input_dir) if os.path.isdir(input_dir) else []
+        self._batch_preview_file = image_files[0] if image_files else ""
+        self.schedule_preview()
+    
+    def schedule_preview(self, *args):
+        """Coalesce bursts of setting changes (e.g. typing) into one preview update"""
+        if self._preview_job is not None:
+            self.root.after_cancel(self._preview_job)
+        self._preview_job = self.root.after(30, self.update_preview)
+    
+    def update_preview(self):
+        self._preview_job = None
+        if self.processing_mode.get() == "single":
+            source = self.input_path.get()
+        else:
+            source = self._batch_preview_file
+        
+        if not source or not os.path.isfile(source):
+            self._preview_source = None
+            self._preview_photo = None
+            self.preview_label.config(image="", text="Select an image to preview")
+            return
+        
+        try:
+            if source != self._preview_source:
+                self._preview_base = self.bot.load_preview(source, PREVIEW_EDGE)
+                self._preview_source = source
+            preview, scale = self._preview_base
+            if self.add_visible.get():
+                preview = self.bot.render_preview(preview, scale, self.visible_text.get(),
+                                                  self.get_selected_positions(),
+                                                  font_size=self.font_size.get(),
+                                                  opacity=self.opacity.get())
+        except tk.TclError:
+            # A spinbox is mid-edit and doesn't hold a number yet
+            return
+        except Exception as e:
+            self._preview_photo = None
+            self.preview_label.config(image="", text=f"Preview unavailable:\n{str(e)}")
+            return
+        
+        # Keep a reference, Tk doesn't hold on to the image itself
+        self._preview_photo = ImageTk.PhotoImage(preview)
+        self.preview_label.config(image=self._preview_photo, text="")
+    
     def get_supported_image_files(self, input_dir):
         """Get all supported image files from input directory"""
         supported_formats = ['.jpg', '.jpeg', '.png', '.bmp', '.tiff']
@@ -226,24 +323,9 @@ class WatermarkBotGUI:
             self.status_label.config(text="Processing image...")
             self.root.update()
             
-            # Build positions list from checkboxes
-            positions = []
-            if self.top_left.get():
-                positions.append('top-left')
-            if self.top_right.get():
-                positions.append('top-right')
-            if self.bottom_left.get():
-                positions.append('bottom-left')
-            if self.bottom_right.get():
-                positions.append('bottom-right')
-            if self.center.get():
-                positions.append('center')
-            
-            # Default to bottom-right if no positions selected
-            if not positions:
-                positions = ['bottom-right']
+            positions = self.get_selected_positions()
             
-            self.bot.process_image(
+            result = self.bot.process_image(
                 input_path=self.input_path.get(),
                 output_path=self.output_path.get(),
                 add_invisible=self.add_invisible.get(),
@@ -254,9 +336,11 @@ class WatermarkBotGUI:
                 font_size=self.font_size.get(),
                 opacity=self.opacity.get()
             )
+            if not result.ok:
+                raise RuntimeError(f"{result.error_type}: {result.error}")
             
             self.status_label.config(text="Image processed successfully!")
-            messagebox.showinfo("Success", f"Image processed successfully!\nSaved to: {self.output_path.get()}")
+            messagebox.showinfo("Success", f"Image processed successfully!\nSaved to: {result.output_path}")
             
         except Exception as e:
             self.status_label.config(text=f"Error: {str(e)}")
@@ -290,32 +374,16 @@ class WatermarkBotGUI:
             self.bot.author_name = self.author_name.get()
             self.bot.website = self.website.get()
             
-            # Build positions list from checkboxes
-            positions = []
-            if self.top_left.get():
-                positions.append('top-left')
-            if self.top_right.get():
-                positions.append('top-right')
-            if self.bottom_left.get():
-                positions.append('bottom-left')
-            if self.bottom_right.get():
-                positions.append('bottom-right')
-            if self.center.get():
-                positions.append('center')
-            
-            # Default to bottom-right if no positions selected
-            if not positions:
-                positions = ['bottom-right']
+            positions = self.get_selected_positions()
             
-            # Process each image
-            successful = 0
-            failed = 0
+            # Process each image; results go to a JSONL report for triage and re-runs
+            report_path = os.path.join(self.output_dir.get(), REPORT_NAME)
             
             self.status_label.config(text=f"Processing {len(image_files)} images...")
             self.root.update()
             
-            for i, image_path in enumerate(image_files, 1):
-                try:
+            with BatchReport(report_path) as report:
+                for i, image_path in enumerate(image_files, 1):
                     # Generate output filename
                     filename = os.path.basename(image_path)
                     name, ext = os.path.splitext(filename)
@@ -327,7 +395,7 @@ class WatermarkBotGUI:
                     self.root.update()
                     
                     # Process the image
-                    self.bot.process_image(
+                    result = self.bot.process_image(
                         input_path=image_path,
                         output_path=output_path,
                         add_invisible=self.add_invisible.get(),
@@ -338,17 +406,15 @@ class WatermarkBotGUI:
                         font_size=self.font_size.get(),
                         opacity=self.opacity.get()
                     )
-                    
-                    successful += 1
-                    
-                except Exception as e:
-                    failed += 1
-                    print(f"✗ Failed to process {filename}: {str(e)}")
+                    report.record(result)
+                    if not result.ok:
+                        print(f"✗ Failed to process {filename}: {result.error_type}: {result.error}")
             
             # Show results
-            self.status_label.config(text=f"Batch processing completed! Successful: {successful}, Failed: {failed}")
+            self.status_label.config(text=f"Batch processing completed! Successful: {report.successful}, Failed: {report.failed}")
             messagebox.showinfo("Batch Processing Complete", 
-                              f"Batch processing completed!\n\nSuccessful: {successful}\nFailed: {failed}\n\nOutput directory: {self.output_dir.get()}")
+                              f"Batch processing completed!\n\nSuccessful: {report.successful}\nFailed: {report.failed}\n\n"
+                              f"Output directory: {self.output_dir.get()}\nReport: {report_path}")
             
         except Exception as e:
             self.status_label.config(text=f"Error: {str(e)}")
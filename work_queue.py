@@ -0,0 +1,227 @@
+#!/usr/bin/env python3
+"""
+Work distribution for batch runs spread over several processes or machines.
+Static sharding splits the input list by a stable hash of each file's name,
+so N nodes given --shard 0/N .. N-1/N process disjoint parts without talking
+to each other. The lease queue is an SQLite database on the shared volume:
+workers seed it with the inputs, lease jobs a few at a time, renew their
+leases while working, and pick up jobs whose lease expired because a worker
+died. SQLite relies on the filesystem's locks, so the shared volume must
+support POSIX locking (NFSv4, or a local disk for single-host runs).
+"""
+
+import argparse
+import contextlib
+import hashlib
+import os
+import socket
+import sqlite3
+import threading
+import time
+
+
+def parse_shard(value):
+    """Parse an 'i/N' shard spec (0 <= i < N) for argparse"""
+    try:
+        index, count = (int(part) for part in value.split('/'))
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"invalid shard: {value} (expected i/N, e.g. 0/4)")
+    if count <= 0 or not 0 <= index < count:
+        raise argparse.ArgumentTypeError(f"invalid shard: {value} (need 0 <= i < N)")
+    return index, count
+
+
+def shard_of(path, count):
+    """
+    Shard a file belongs to
+
+    Hashes the file name rather than the full path, so nodes that mount the
+    shared volume at different paths still agree on the partition.
+    """
+    digest = hashlib.sha1(os.path.basename(path).encode('utf-8')).digest()
+    return int.from_bytes(digest[:8], 'big') % count
+
+
+def default_worker_id():
+    return f"{socket.gethostname()}:{os.getpid()}"
+
+
+class LeaseQueue:
+    def __init__(self, db_path, lease_seconds=300, max_attempts=3):
+        """
+        Open (or create) a job queue database
+
+        Args:
+            db_path (str): SQLite file, on a volume every worker can reach
+            lease_seconds (float): How long a leased job stays reserved without a renewal
+            max_attempts (int): Leases a job may be given before it is failed (a job whose
+                worker keeps dying is not retried forever)
+        """
+        self.db_path = db_path
+        self.lease_seconds = lease_seconds
+        self.max_attempts = max_attempts
+        # Autocommit mode; write transactions are opened explicitly with BEGIN IMMEDIATE
+        self.db = sqlite3.connect(db_path, timeout=60, isolation_level=None)
+        self.db.execute("""
+            CREATE TABLE IF NOT EXISTS jobs (
+                name TEXT PRIMARY KEY,
+                status TEXT NOT NULL DEFAULT 'pending',
+                owner TEXT,
+                lease_until REAL,
+                attempts INTEGER NOT NULL DEFAULT 0,
+                error TEXT
+            )""")
+        self.db.execute("CREATE INDEX IF NOT EXISTS jobs_status ON jobs (status, lease_until)")
+
+    def close(self):
+        self.db.close()
+
+    @contextlib.contextmanager
+    def _transaction(self):
+        """Write transaction, taking SQLite's write lock up front so concurrent workers queue for it"""
+        self.db.execute("BEGIN IMMEDIATE")
+        try:
+            yield
+        except BaseException:
+            self.db.execute("ROLLBACK")
+            raise
+        self.db.execute("COMMIT")
+
+    def enqueue(self, jobs):
+        """
+        Add jobs that aren't in the queue yet (safe for every worker to call with the same list)
+
+        Args:
+            jobs (list): File names relative to the input directory (nodes may mount the
+                shared volume at different paths)
+
+        Returns:
+            int: Number of jobs added
+        """
+        with self._transaction():
+            before = self.db.total_changes
+            self.db.executemany("INSERT OR IGNORE INTO jobs (name) VALUES (?)", [(name,) for name in jobs])
+            return self.db.total_changes - before
+
+    def requeue(self, names):
+        """
+        Give failed jobs a fresh start (e.g. when re-running a report's failures)
+
+        Args:
+            names (list): Job names; jobs that aren't failed are left alone
+
+        Returns:
+            int: Number of jobs put back to pending
+        """
+        with self._transaction():
+            before = self.db.total_changes
+            self.db.executemany(
+                "UPDATE jobs SET status = 'pending', owner = NULL, lease_until = NULL, attempts = 0, error = NULL "
+                "WHERE name = ? AND status = 'failed'", [(name,) for name in names])
+            return self.db.total_changes - before
+
+    def lease(self, worker_id, count=1):
+        """
+        Reserve up to count jobs, taking over jobs whose lease has expired
+
+        Returns:
+            list: Names of the jobs now leased to worker_id
+        """
+        now = time.time()
+        with self._transaction():
+            # Jobs whose worker died max_attempts times are given up on
+            self.db.execute(
+                "UPDATE jobs SET status = 'failed', error = 'Lease expired ' || attempts || ' times' "
+                "WHERE status = 'leased' AND lease_until < ? AND attempts >= ?", (now, self.max_attempts))
+            rows = self.db.execute(
+                "SELECT name FROM jobs "
+                "WHERE status = 'pending' OR (status = 'leased' AND lease_until < ?) "
+                "ORDER BY name LIMIT ?", (now, count)).fetchall()
+            self.db.executemany(
+                "UPDATE jobs SET status = 'leased', owner = ?, lease_until = ?, attempts = attempts + 1 "
+                "WHERE name = ?", [(worker_id, now + self.lease_seconds, row[0]) for row in rows])
+        return [row[0] for row in rows]
+
+    def renew(self, worker_id, names):
+        """Extend worker_id's leases on the named jobs"""
+        with self._transaction():
+            self.db.executemany(
+                "UPDATE jobs SET lease_until = ? WHERE name = ? AND owner = ? AND status = 'leased'",
+                [(time.time() + self.lease_seconds, name, worker_id) for name in names])
+
+    def complete(self, worker_id, name, error=None):
+        """
+        Record the outcome of a leased job
+
+        A job whose lease was taken over by another worker meanwhile is left to that worker.
+
+        Args:
+            worker_id (str): Worker that processed the job
+            name (str): Job name
+            error (str): Failure message, or None on success
+        """
+        with self._transaction():
+            self.db.execute(
+                "UPDATE jobs SET status = ?, error = ?, lease_until = NULL "
+                "WHERE name = ? AND owner = ? AND status = 'leased'",
+                ('failed' if error else 'done', error, name, worker_id))
+
+    def release(self, worker_id, names):
+        """Hand unstarted leased jobs back to the queue"""
+        with self._transaction():
+            self.db.executemany(
+                "UPDATE jobs SET status = 'pending', owner = NULL, lease_until = NULL, attempts = attempts - 1 "
+                "WHERE name = ? AND owner = ? AND status = 'leased'",
+                [(name, worker_id) for name in names])
+
+    def outstanding(self):
+        """Number of jobs still pending or leased"""
+        return self.db.execute("SELECT COUNT(*) FROM jobs WHERE status IN ('pending', 'leased')").fetchone()[0]
+
+    def counts(self):
+        """Number of jobs in each status"""
+        return dict(self.db.execute("SELECT status, COUNT(*) FROM jobs GROUP BY status").fetchall())
+
+
+class LeaseKeeper:
+    def __init__(self, queue, worker_id):
+        """
+        Renew a worker's leases in the background while it works on them
+
+        Uses its own database connection (SQLite connections are per thread), renewing
+        every third of the lease time, so a single long job (e.g. a video) keeps its lease.
+
+        Args:
+            queue (LeaseQueue): Queue the leases were taken from
+            worker_id (str): Worker holding the leases
+        """
+        self.queue = queue
+        self.worker_id = worker_id
+        self.held = []
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name='lease-keeper', daemon=True)
+
+    def hold(self, names):
+        """Set the jobs to keep leased"""
+        with self._lock:
+            self.held = list(names)
+
+    def _run(self):
+        queue = LeaseQueue(self.queue.db_path, self.queue.lease_seconds, self.queue.max_attempts)
+        try:
+            while not self._stop.wait(self.queue.lease_seconds / 3):
+                with self._lock:
+                    held = list(self.held)
+                if held:
+                    queue.renew(self.worker_id, held)
+        finally:
+            queue.close()
+
+    def __enter__(self):
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self._stop.set()
+        self._thread.join()